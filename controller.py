@@ -1,22 +1,29 @@
+import asyncio
+from collections import deque
 from datetime import datetime
-from psutil import process_iter
-from signal import SIGTERM
 import threading
-from time import sleep
+from time import time
+from types import SimpleNamespace
 
-from pythonosc.osc_server import ThreadingOSCUDPServer
+import numpy as np
+
+from pythonosc.osc_server import AsyncIOOSCUDPServer
 from pythonosc.dispatcher import Dispatcher
 from rtmidi import MidiIn, MidiOut
 
 
 # this is for KORG nanoKONTROL2:
 num_controls = 8
+num_banks = 1  # tracks = num_controls * num_banks; the hardware controls the active bank (switch with "g"), OSC can address all tracks
+bank_cc_stride = 128  # controls of track k are kept under the CC of its hardware control + bank * bank_cc_stride
 knob_center = 64
 slider_cc = 0
 knob_cc = 16
 state_cc = dict(s=32, m=48, r=64)
 transport_cc = dict(play=41, stop=42, rew=43, ff=44, rec=45, cycle=46, track_rew=58, track_ff=59, set=60, marker_rew=61, marker_ff=62)
 max_cc = 100
+max_led_messages = 8  # LED messages sent per control pass, so that bursts (e.g. toggling all tracks) do not hold up the incoming CCs
+blink_secs = 0.2
 transport_led = ['play', 'stop', 'rew', 'ff', 'rec', 'cycle']
 transport_toggle = ['play', 'rec', 'cycle', 'set']
 cc2transport = {v: k for k, v in transport_cc.items()}
@@ -28,61 +35,169 @@ knob_modes = ['syn-pitch', 'smp-pitch', 'smp-scrub']
 global_control_labels = dict(slider_up='SLIDER UP', solo_exclusive='SOLO EXCL', solo_defeats_mute='SOLO>MUTE', mute_override='MUTE OVER', rec_exclusive='REC. EXCL', osc='-= OSC =-')
 ip = '0.0.0.0'
 port = 1337
+osc_verbose = False
+# OSC addresses (case-insensitive): /slider/1../slider/8, /knob/1../knob/8, /s/1.., /m/1.., /r/1.., /play, /stop, ... (see transport_cc), /cc/<number>
+# float values up to 1.0 (e.g. from TouchOSC) are scaled to 0..127
+osc_continuous = ['slider', 'knob', 'cc']  # bursts to these are coalesced to the last value per address; button events are dispatched in order
+state_fields = ['global_controls', 'controls', 'knob_mode', 'knob_memory', 'bank', 'states', 'transport', 'track_register', 'marker_register', 'transport_register', 'stopped']
 
 
 class Controller:
-    def __init__(self, initial_knob_mode):
+    def __init__(self, initial_knob_mode, midi_in=None, midi_out=None):
         self.num_controls = num_controls
+        self.num_banks = num_banks
+        self.num_tracks = num_controls * num_banks
+        self.bank = 0
         self.slider_cc = slider_cc
         self.knob_cc = knob_cc
         self.knob_center = knob_center
+        self.slider_ccs = np.array([self.track_cc(k, slider_cc) for k in range(self.num_tracks)])  # the keys in controls of all tracks, for vectorized access
+        self.knob_ccs = np.array([self.track_cc(k, knob_cc) for k in range(self.num_tracks)])
         self.global_control_labels = global_control_labels
         self.knob_modes = knob_modes
         self.initial_knob_mode = initial_knob_mode
-        self.midi_in = MidiIn()
-        self.midi_out = MidiOut()
-        self.reset()
+        self.midi_in = midi_in or MidiIn()
+        self.midi_out = midi_out or MidiOut()
         self.osc_server = None
-        #self.start_osc()
+        self.osc_dict = {}
+        self.osc_lock = threading.Lock()
+        self.osc_pending = {}
+        self.osc_events = deque()
+        self.recorder = None  # an event_log.EventRecorder while capturing
+        self.led_values = {}  # the LED state of each CC as the controller sees it
+        self.leds = {}  # what was last sent to the device, so that only changes are sent
+        self.led_queue = {}
+        self.blink = deque()  # pending (time, value) steps of the blink animation, where None restores led_values
+        self.reset()
 
     def start_osc(self):
-        for proc in process_iter():
-            for conns in proc.connections():
-                if conns.laddr.port == port:
-                    proc.send_signal(SIGTERM)
-                    sleep(1)
-                    break
+        if self.osc_server:
+            return True
 
         def handler(address, *args):
-            print(f'{datetime.now()} {address}: {args}')
+            if osc_verbose:
+                print(f'{datetime.now()} {address}: {args}')
             address = address[1:].lower()
             if args:
-                self.osc_dict[address] = args[0]
+                with self.osc_lock:
+                    if address.split('/', 1)[0] in osc_continuous:
+                        self.osc_pending[address] = args[0]
+                    else:
+                        self.osc_events.append((address, args[0]))
 
-        self.osc_dict = {}
         dispatcher = Dispatcher()
         dispatcher.set_default_handler(handler)
-        self.osc_server = ThreadingOSCUDPServer((ip, port), dispatcher)
-        thread = threading.Thread(target=self.osc_server.serve_forever)
-        thread.daemon = True
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
         thread.start()
+        server = AsyncIOOSCUDPServer((ip, port), dispatcher, loop)
+        try:
+            transport, _ = asyncio.run_coroutine_threadsafe(server.create_serve_endpoint(), loop).result()
+        except OSError as e:
+            print('Could not start OSC server on port', port, e)
+            loop.call_soon_threadsafe(loop.stop)
+            return False
+        self.osc_server = SimpleNamespace(loop=loop, thread=thread, transport=transport)
+        return True
+
+    def stop_osc(self):
+        if self.osc_server:
+            loop = self.osc_server.loop
+            transport = self.osc_server.transport
+            loop.call_soon_threadsafe(lambda: (transport.close(), loop.call_soon(loop.stop)))  # let the transport release the port before stopping
+            self.osc_server.thread.join(timeout=1)
+            self.osc_server = None
+
+    def osc_to_cc(self, address, val):
+        if isinstance(val, float) and abs(val) <= 1:
+            val *= 127
+        name, _, num = address.partition('/')
+        if name in transport_cc:
+            return None, transport_cc[name], val
+        try:
+            num = int(num)
+        except ValueError:
+            return None, None, val
+        if name == 'cc':
+            return None, num, val
+        bank, k = divmod(num - 1, self.num_controls)
+        if not 0 <= bank < self.num_banks:
+            return None, None, val
+        if name == 'slider':
+            return bank, k + self.slider_cc, val
+        if name == 'knob':
+            return bank, k + self.knob_cc, val
+        if name in state_cc:
+            return bank, k + state_cc[name], val
+        return None, None, val
+
+    def is_toggle_cc(self, cc):
+        if cc in cc2transport:
+            return cc2transport[cc] in transport_toggle
+        return any(0 <= cc - state_cc[state_name] < self.num_controls for state_name in state_cc)
+
+    def poll_osc(self):
+        # dispatches the coalesced controls and the queued button events (at most one per address per call, so that presses and releases are seen on separate passes) through the MIDI control path
+        if not self.osc_server:
+            return 0
+        with self.osc_lock:
+            pending, self.osc_pending = self.osc_pending, {}
+            events = []
+            addresses = set()
+            while self.osc_events and self.osc_events[0][0] not in addresses:
+                events.append(self.osc_events.popleft())
+                addresses.add(events[-1][0])
+        count = 0
+        for address, val in list(pending.items()) + events:
+            self.osc_dict[address] = val
+            bank, cc, val = self.osc_to_cc(address, val)
+            if cc is not None:
+                if external_led_mode and self.is_toggle_cc(cc) and not val:
+                    continue  # toggle buttons flip on any message, so ignore the releases
+                self.update_single(cc, round(val), bank=bank)
+                count += 1
+        return count
+
+    def track_cc(self, k, base_cc):
+        # the key in controls of the hardware control at base_cc for track k
+        return base_cc + k % self.num_controls + k // self.num_controls * bank_cc_stride
+
+    def cc_track(self, cc, base_cc):
+        bank, cc = divmod(cc, bank_cc_stride)
+        if 0 <= cc - base_cc < self.num_controls and bank < self.num_banks:
+            return bank*self.num_controls + cc - base_cc
+        return None
+
+    def bank_tracks(self):
+        return range(self.bank * self.num_controls, (self.bank+1) * self.num_controls)
+
+    def next_bank(self):
+        self.bank = (self.bank+1) % self.num_banks
+        self.refresh_for_display()
+        if external_led_mode:
+            for state_name in self.states:
+                for k in self.bank_tracks():
+                    self.set_led(state_cc[state_name] + k % self.num_controls, self.states[state_name][k])
 
     def refresh_for_display(self):
-        self.new_controls.update(self.controls)
+        for ccs in self.slider_ccs, self.knob_ccs:
+            self.new_controls.update(zip(ccs.tolist(), self.controls[ccs].tolist()))
 
     def refresh_sliders_of_knobs(self):
-        for k in range(self.num_controls):
-            if k + self.knob_cc in self.new_controls:
-                self.new_controls[k + self.slider_cc] = self.controls[k + self.slider_cc]
+        for k in range(self.num_tracks):
+            if self.track_cc(k, self.knob_cc) in self.new_controls:
+                self.new_controls[self.track_cc(k, self.slider_cc)] = self.controls[self.track_cc(k, self.slider_cc)]
 
     def reset(self):
+        self.stop_osc()
         self.global_controls = dict.fromkeys(self.global_control_labels, False)
-        self.controls = {}
+        self.controls = np.zeros(self.num_banks * bank_cc_stride, dtype=np.int16)  # indexed by CC, of which only the sliders and knobs are used
         self.new_controls = {}
         self.knob_mode = self.knob_modes[self.initial_knob_mode]
         self.reset_sliders()
         self.reset_knobs()
-        self.states = {state_name: dict.fromkeys(range(self.num_controls), False) for state_name in state_cc}
+        self.bank = 0
+        self.states = {state_name: np.zeros(self.num_tracks, dtype=bool) for state_name in state_cc}
         self.transport = dict.fromkeys(transport_cc, False)
         self.track_register = dict(syn=0, smp=0)
         self.marker_register = 0
@@ -91,6 +206,18 @@ class Controller:
         self.blink_leds()
         self.stopped = True
 
+    def get_state(self):
+        # the controller state that the synths read, e.g. for mirroring it in render workers
+        return {field: getattr(self, field) for field in state_fields}
+
+    def set_state(self, state):
+        for field, value in state.items():
+            setattr(self, field, value)
+        self.controls = np.asarray(self.controls, dtype=np.int16)  # lists when read back from JSON
+        self.states = {state_name: np.asarray(value, dtype=bool) for state_name, value in self.states.items()}
+        self.new_states = {state_name: {} for state_name in self.states}  # pending changes refer to the replaced state
+        self.new_transport = {}
+
     def reset_midi(self):
         self.midi_in.close_port()
         self.midi_out.close_port()
@@ -105,44 +232,74 @@ class Controller:
         assert out_ports, ('Could not find out MIDI port', out_port_device)
         self.midi_in.open_port(in_ports[0])
         self.midi_out.open_port(out_ports[0])
-        self.new_states = {state_name: self.states[state_name].copy() for state_name in self.states}
+        self.leds = {}  # the device may have been replugged, so resend everything
+        for cc, val in self.led_values.items():
+            self.queue_led(cc, val)
+        self.resend_states()
+
+    def resend_states(self):
+        # marks all the states and transport buttons as changed, so that update_all sends their LEDs
+        self.new_states = {state_name: dict(enumerate(self.states[state_name].tolist())) for state_name in self.states}
         self.new_transport = self.transport.copy()
 
+    def poll_midi(self):
+        count = 0
+        msg = self.midi_in.get_message()
+        while msg:
+            self.update_single(*msg[0][1:])
+            count += 1
+            msg = self.midi_in.get_message()
+        return count
+
     def send_msg(self, cc, val):
         self.midi_out.send_message([176, cc, val * 127])
 
-    def blink_leds(self, blink_leds_delay=0.2):
-        if external_led_mode:
-            for cc in range(max_cc):
-                self.send_msg(cc, False)
-            sleep(blink_leds_delay)
-            for cc in range(max_cc):
-                self.send_msg(cc, True)
-            sleep(blink_leds_delay)
+    def set_led(self, cc, val):
+        val = bool(val)
+        self.led_values[cc] = val
+        if not self.blink:
+            self.queue_led(cc, val)
+
+    def queue_led(self, cc, val):
+        if self.leds.get(cc) == val:
+            self.led_queue.pop(cc, None)
+        else:
+            self.led_queue[cc] = val
+
+    def flush_leds(self):
+        # advances the blink animation and sends up to max_led_messages of the changed LEDs, leaving the rest for the next passes
+        while self.blink and self.blink[0][0] <= time():
+            val = self.blink.popleft()[1]
             for cc in range(max_cc):
-                self.send_msg(cc, False)
+                self.queue_led(cc, self.led_values.get(cc, False) if val is None else val)
+        for cc in list(self.led_queue)[:max_led_messages]:
+            val = self.led_queue.pop(cc)
+            self.send_msg(cc, val)
+            self.leds[cc] = val
+
+    def blink_leds(self, blink_leds_delay=blink_secs):
+        # runs along the control passes instead of blocking
+        if external_led_mode:
+            now = time()
+            self.blink = deque([(now, False), (now + blink_leds_delay, True), (now + 2*blink_leds_delay, None)])
 
     def reset_sliders(self):
-        for k in range(self.num_controls):
-            cc = k + self.slider_cc
-            self.controls[cc] = 0
-            self.new_controls[cc] = 0
+        self.controls[self.slider_ccs] = 0
+        self.new_controls.update(dict.fromkeys(self.slider_ccs.tolist(), 0))
 
     def reset_knobs(self):
-        for k in range(self.num_controls):
-            cc = k + self.knob_cc
-            self.controls[cc] = self.knob_center
-            self.new_controls[cc] = self.knob_center
-        self.knob_memory = {knob_mode: [self.knob_center] * self.num_controls for knob_mode in self.knob_modes}
+        self.controls[self.knob_ccs] = self.knob_center
+        self.new_controls.update(dict.fromkeys(self.knob_ccs.tolist(), self.knob_center))
+        self.knob_memory = {knob_mode: [self.knob_center] * self.num_tracks for knob_mode in self.knob_modes}
 
     def toggle_knob_mode(self, is_sampler=None, track=None):
         mode = 'syn-pitch'
         if is_sampler or is_sampler is None and self.knob_mode.startswith('smp'):
             mode = 'smp-scrub' if self.transport.get('cycle') else 'smp-pitch'
         if mode != self.knob_mode:
-            for k in range(self.num_controls) if track is None else [track]:
-                cc = k + self.knob_cc
-                self.knob_memory[self.knob_mode][k] = self.controls[cc]
+            for k in range(self.num_tracks) if track is None else [track]:
+                cc = self.track_cc(k, self.knob_cc)
+                self.knob_memory[self.knob_mode][k] = int(self.controls[cc])
                 self.controls[cc] = self.knob_memory[mode][k]
                 self.new_controls[cc] = self.controls[cc]
             self.knob_mode = mode
@@ -154,9 +311,7 @@ class Controller:
         if k is None:
             return 0
         mode_controls = self.controls
-        i = k + knob_cc
-        if i not in self.controls:
-            return 0
+        i = self.track_cc(k, self.knob_cc)
         if mode != self.knob_mode and mode in self.knob_memory:
             mode_controls = self.knob_memory[mode]
             i = k
@@ -165,27 +320,29 @@ class Controller:
     def get_slider(self, k):
         if k is None:
             return 0
-        cc = k + slider_cc
-        if cc in self.controls:
-            return self.controls[cc] / 127
-        return 0
+        return self.controls[self.track_cc(k, self.slider_cc)] / 127
 
     def relative_track(self, k):
         if k is None:
             return 0
-        return k / max(self.num_controls - 1, 1)
+        return k / max(self.num_tracks - 1, 1)
 
     def toggle_all(self, state_names, val):
         if external_led_mode:
             for state_name in state_names:
                 if state_name in state_cc:
-                    self.new_states[state_name] = dict.fromkeys(range(self.num_controls), val)
+                    self.new_states[state_name] = dict.fromkeys(range(self.num_tracks), val)
 
-    def update_single(self, cc, val):
+    def update_single(self, cc, val, bank=None):
+        # cc is the hardware CC, which controls the active bank unless another bank is given
         cc = int(cc)
         val = int(val)
+        if bank is None:
+            bank = self.bank
+        if self.recorder:
+            self.recorder.cc(cc, val, bank)
         if 0 <= cc - self.slider_cc < self.num_controls or 0 <= cc - self.knob_cc < self.num_controls and (self.knob_mode.startswith('smp') or not self.transport.get('cycle')):
-            self.new_controls[cc] = val
+            self.new_controls[cc + bank*bank_cc_stride] = val
         elif cc in cc2transport:
             trans = cc2transport[cc]
             self.new_transport[trans] = not self.transport[trans] if external_led_mode and trans in transport_toggle else val > 0
@@ -193,31 +350,34 @@ class Controller:
             for state_name in self.states:
                 k = cc - state_cc[state_name]
                 if 0 <= k < self.num_controls:
+                    k += bank * self.num_controls
                     self.new_states[state_name][k] = not self.states[state_name][k] if external_led_mode else val > 0
                     break
 
     def update_all(self):
         if self.global_controls['slider_up'] and 's' in state_cc:
             for cc in self.new_controls:
-                k = cc - self.slider_cc
-                if 0 <= k < self.num_controls and self.new_controls[cc] > self.controls[cc] > 0:
+                k = self.cc_track(cc, self.slider_cc)
+                if k is not None and self.new_controls[cc] > self.controls[cc] > 0:
                     self.new_states['s'][k] = True
 
         if self.global_controls['solo_exclusive'] or self.global_controls['rec_exclusive']:
-            for k in range(self.num_controls):
+            for k in range(self.num_tracks):
                 if self.global_controls['solo_exclusive'] and 's' in state_cc and any(self.new_states['s'].values()) and self.states['s'][k] and k not in self.new_states['s']:
                     self.new_states['s'][k] = False
                 if self.global_controls['rec_exclusive'] and 'r' in state_cc and any(self.new_states['r'].values()) and self.states['r'][k] and k not in self.new_states['r']:
                     self.new_states['r'][k] = False
 
-        self.controls.update(self.new_controls)
+        if self.new_controls:
+            self.controls[list(self.new_controls)] = list(self.new_controls.values())
         for state_name in self.new_states:
             for k, v in self.new_states[state_name].items():
-                self.new_controls[k + self.slider_cc] = self.controls[k + self.slider_cc]
-                self.new_controls[k + self.knob_cc] = self.controls[k + self.knob_cc]
-                if external_led_mode:
-                    self.send_msg(state_cc[state_name] + k, v)
-            self.states[state_name].update(self.new_states[state_name])
+                self.new_controls[self.track_cc(k, self.slider_cc)] = self.controls[self.track_cc(k, self.slider_cc)]
+                self.new_controls[self.track_cc(k, self.knob_cc)] = self.controls[self.track_cc(k, self.knob_cc)]
+                if external_led_mode and k // self.num_controls == self.bank:
+                    self.set_led(state_cc[state_name] + k % self.num_controls, v)
+            if self.new_states[state_name]:
+                self.states[state_name][list(self.new_states[state_name])] = list(self.new_states[state_name].values())
         self.new_states = {state_name: {} for state_name in self.states}
 
         if self.transport.get('stop') and not self.new_transport.get('stop', True):  # works on release
@@ -247,14 +407,25 @@ class Controller:
             if trans == 'set' and self.knob_mode.startswith('smp'):
                 refresh_knobs = True
             if external_led_mode and trans in transport_led:
-                self.send_msg(transport_cc[trans], v)
+                self.set_led(transport_cc[trans], v)
         if refresh_knobs:
-            for k in range(self.num_controls):
-                self.new_controls[k + self.knob_cc] = self.controls[k + self.knob_cc]
+            self.new_controls.update(zip(self.knob_ccs.tolist(), self.controls[self.knob_ccs].tolist()))
         self.transport.update(self.new_transport)
         if 'cycle' in self.new_transport:
             self.toggle_knob_mode()
         self.new_transport = {}
+        self.flush_leds()
 
     def is_effective_mute(self, k):
-        return self.global_controls['mute_override'] or k < self.num_controls and (not self.global_controls['solo_defeats_mute'] and 'm' in self.states and self.states['m'].get(k) or 's' in self.states and not self.states['s'].get(k) and any(self.states['s'].values()))
+        return self.global_controls['mute_override'] or k < self.num_tracks and self.effective_mutes()[k]
+
+    def effective_mutes(self):
+        # is_effective_mute for all the tracks at once
+        if self.global_controls['mute_override']:
+            return np.ones(self.num_tracks, dtype=bool)
+        mutes = np.zeros(self.num_tracks, dtype=bool)
+        if not self.global_controls['solo_defeats_mute'] and 'm' in self.states:
+            mutes |= self.states['m']
+        if 's' in self.states and self.states['s'].any():
+            mutes |= ~self.states['s']
+        return mutes
@@ -0,0 +1,269 @@
+import argparse
+import json
+import os
+import socket
+import threading
+from time import sleep, time
+
+from controller import Controller
+from event_log import decode_state, encode_state
+from profiler import profiler
+import pythotron
+from session import restore_session, save_session
+import soundscape
+from soundscape import Soundscape
+from synths import kernels_warm, warmup_kernels
+
+
+# runs the controller, MIDI, OSC and the soundscape headlessly, so that UI redraws do not compete with the audio for the GIL
+# UIs attach with "python pythotron.py --connect", receive state snapshots and send their key presses; several UIs can attach to one engine
+# usage: python engine.py [--socket pythotron.sock]
+socket_path = 'pythotron.sock'
+tcp_port = 1338  # on localhost, where Unix sockets are not available
+snapshot_secs = 0.02  # minimal interval between snapshots
+heartbeat_secs = 0.5  # maximal interval between snapshots, which also carry the profiler lines
+max_backlog_bytes = 1 << 20  # UIs that leave more unsent messages are dropped, as sending never blocks the control loop
+realtime_priority = 50  # SCHED_RR priority of the audio callback threads, while the control loop and the background threads keep the default
+fallback_nice = -10
+
+
+def address(path=socket_path):
+    return path if hasattr(socket, 'AF_UNIX') else ('127.0.0.1', tcp_port)
+
+
+def new_socket():
+    return socket.socket(socket.AF_UNIX if hasattr(socket, 'AF_UNIX') else socket.AF_INET)
+
+
+def raise_priority():
+    # of the calling thread; needs privileges (e.g. an rtprio limit in /etc/security/limits.conf), otherwise the default scheduling stays; returns what was set
+    try:
+        os.sched_setscheduler(0, os.SCHED_RR, os.sched_param(realtime_priority))
+        return f'SCHED_RR {realtime_priority}'
+    except (AttributeError, OSError):
+        pass
+    try:
+        os.nice(fallback_nice)
+        return f'nice {fallback_nice}'
+    except (AttributeError, OSError):
+        return None
+
+
+class Connection:
+    # newline separated JSON messages over a non-blocking stream socket
+    def __init__(self, sock):
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.buffer = b''
+        self.backlog = b''  # the sent messages that the socket did not take yet
+
+    def send(self, **message):
+        # raises ConnectionError when the peer stopped reading
+        self.backlog += json.dumps(message).encode() + b'\n'
+        self.flush()
+        if len(self.backlog) > max_backlog_bytes:
+            raise ConnectionError('peer stalled')
+
+    def flush(self):
+        while self.backlog:
+            try:
+                sent = self.sock.send(self.backlog)
+            except BlockingIOError:
+                return
+            self.backlog = self.backlog[sent:]
+
+    def receive(self):
+        # returns the complete messages received so far; raises ConnectionError when the peer closed
+        while True:
+            try:
+                data = self.sock.recv(1 << 16)
+            except BlockingIOError:
+                break
+            if not data:
+                raise ConnectionError('connection closed')
+            self.buffer += data
+        *lines, self.buffer = self.buffer.split(b'\n')
+        return [decode_state(json.loads(line)) for line in lines if line.strip()]
+
+    def close(self):
+        self.sock.close()
+
+
+class Engine:
+    def __init__(self, ctrl, sound, path=socket_path):
+        self.ctrl = ctrl
+        self.sound = sound
+        self.path = path
+        self.server = new_socket()
+        if isinstance(address(path), str) and os.path.exists(path):
+            os.remove(path)  # left by an engine that did not exit cleanly
+        self.server.bind(address(path))
+        self.server.listen()
+        self.server.setblocking(False)
+        self.clients = []
+        self.pending_controls = {}  # the changed controls since the last snapshot
+        self.snapshot = None  # the last sent state and displays, None to send the next one in any case
+        self.snapshot_time = 0
+
+    def accept(self):
+        while True:
+            try:
+                sock, _ = self.server.accept()
+            except BlockingIOError:
+                return
+            self.clients.append(Connection(sock))
+            self.snapshot = None
+
+    def drop(self, client):
+        self.clients.remove(client)
+        client.close()
+
+    def flush(self):
+        for client in list(self.clients):
+            try:
+                client.flush()
+            except OSError:
+                self.drop(client)
+
+    def poll_clients(self):
+        count = 0
+        for client in list(self.clients):
+            try:
+                for message in client.receive():
+                    if 'key' in message:
+                        self.key(message['key'])
+                        count += 1
+            except (OSError, ValueError):
+                self.drop(client)
+        return count
+
+    def key(self, key_code):
+        # the keys that the UIs do not handle themselves
+        c = pythotron.key_char(key_code)
+        if c in ['c', 'ב']:
+            pythotron.toggle_capture(self.ctrl, self.sound)
+        elif c in ['o', 'ם']:
+            pythotron.toggle_osc(self.ctrl)
+        elif c in ['j', 'ח']:
+            profiler.dump()
+        elif c in ['n', 'מ']:
+            save_session(self.ctrl, self.sound)
+        elif c in ['b', 'נ']:
+            if not restore_session(self.ctrl, self.sound):
+                self.ctrl.refresh_for_display()  # the UIs cleared their screens
+            self.snapshot = None
+        else:
+            if self.ctrl.recorder:
+                self.ctrl.recorder.key(key_code)
+            pythotron.handle_key(key_code, self.ctrl, self.sound)
+
+    def publish(self):
+        # sends a snapshot when the state or the displays changed, at most every snapshot_secs and at least every heartbeat_secs
+        self.pending_controls.update(self.ctrl.new_controls)
+        now = time()
+        if not self.clients or now - self.snapshot_time < snapshot_secs:
+            return
+        state = encode_state(self.ctrl.get_state())
+        displays = encode_state(dict(synth_ind=self.sound.synth_ind, synth_disp=self.sound.synth_disp, second_disp=self.sound.second_disp,
+                                     notes=self.sound.notes, chords=self.sound.chords, capture=bool(self.ctrl.recorder), warm=kernels_warm.is_set()))
+        if (state, displays) == self.snapshot and not self.pending_controls and now - self.snapshot_time < heartbeat_secs:
+            return
+        for client in list(self.clients):
+            try:
+                client.send(state=state, controls=encode_state(self.pending_controls), profiler=profiler.lines(), **displays)
+            except OSError:
+                self.drop(client)
+        self.snapshot = (state, displays)
+        self.snapshot_time = now
+        self.pending_controls = {}
+
+    def run(self):
+        # the control loop of pythotron.main_loop without the screen; the keys are handled first, as they are at the end of the previous pass there
+        while True:
+            self.accept()
+            profiler.gauge('ui', self.poll_clients())
+            profiler.gauge('midi', self.ctrl.poll_midi())
+            profiler.gauge('osc', self.ctrl.poll_osc())
+            self.ctrl.update_all()
+            self.sound.update()
+            self.publish()
+            self.flush()
+            self.ctrl.new_controls = {}
+            sleep(pythotron.main_loop_delay)
+
+    def close(self):
+        for client in self.clients:
+            client.close()
+        self.clients = []
+        self.server.close()
+        if isinstance(address(self.path), str) and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class EngineClient:
+    # the UI side, which mirrors the engine state into a local controller and stands in for the soundscape in pythotron.main_loop
+    hasattr_partial = staticmethod(Soundscape.hasattr_partial)
+
+    def __init__(self, ctrl, path=socket_path):
+        self.ctrl = ctrl
+        sock = new_socket()
+        sock.connect(address(path))
+        self.connection = Connection(sock)
+        self.synth_ind = None
+        self.profiler_lines = []
+        while self.synth_ind is None:
+            self.poll()
+            sleep(pythotron.main_loop_delay)
+        self.ctrl.new_controls = {}  # the local controller started from its reset values
+        self.ctrl.refresh_for_display()
+
+    def poll(self):
+        # applies the snapshots received since the last call; returns the global controls that changed
+        global_controls = self.ctrl.global_controls.copy()
+        self.connection.flush()
+        for message in self.connection.receive():
+            self.ctrl.set_state(message['state'])
+            self.ctrl.new_controls.update(message['controls'])
+            self.profiler_lines = message['profiler']
+            for field in ['synth_ind', 'synth_disp', 'second_disp', 'notes', 'chords', 'capture', 'warm']:
+                setattr(self, field, message[field])
+        return [control for control, value in self.ctrl.global_controls.items() if value != global_controls.get(control)]
+
+    def track_peaks(self, k):
+        return None  # the samples stay in the engine, so remote UIs show no waveforms
+
+    def send_key(self, key_code):
+        self.connection.send(key=key_code)
+
+    def close(self):
+        self.connection.close()
+
+    kill_sound = close  # the engine keeps playing
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=pythotron.title + ' engine')
+    parser.add_argument('--socket', default=socket_path, help='the Unix socket to listen on')
+    parser.add_argument('--restore', nargs='?', const='', metavar='SESSION', help='restore a session saved with "n" (default: the latest)')
+    args = parser.parse_args()
+
+    threading.Thread(target=warmup_kernels, daemon=True).start()
+    soundscape.audio_thread_init = raise_priority
+    controller = Controller(pythotron.initial_knob_mode)
+    sound = Soundscape(controller, pythotron.synths, pythotron.notes, pythotron.sample_folder,
+                       pythotron.synth_max_bend_semitones, pythotron.sampler_max_bend_semitones)
+    if args.restore is not None:
+        restore_session(controller, sound, args.restore)
+    engine = Engine(controller, sound, args.socket)
+    print('Listening on', address(args.socket))
+    with controller.midi_in, controller.midi_out:
+        try:
+            engine.run()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if controller.recorder:
+                controller.recorder.close()
+            controller.stop_osc()
+            sound.kill_sound()
+            engine.close()
@@ -0,0 +1,63 @@
+from datetime import datetime
+import json
+import os
+from time import perf_counter
+
+
+log_folder = 'event_logs'
+log_version = 1
+
+
+def encode_state(state):
+    # JSON turns int keys into strings, which decode_state turns back, and arrays into lists, which Controller.set_state turns back
+    return json.loads(json.dumps(state, default=lambda array: array.tolist()))
+
+
+def decode_state(state):
+    if isinstance(state, dict):
+        return {int(k) if isinstance(k, str) and k.lstrip('-').isdigit() else k: decode_state(v) for k, v in state.items()}
+    if isinstance(state, list):
+        return [decode_state(v) for v in state]
+    return state
+
+
+class EventRecorder:
+    # logs the events reaching the controller (MIDI and OSC as CC messages, keys and session restores), timed from the start of the capture, as JSON lines
+    # the first line is a header with the controller state to replay from, and the last line marks the end of the capture
+    def __init__(self, ctrl, sound, path=None):
+        if path is None:
+            os.makedirs(log_folder, exist_ok=True)
+            path = os.path.join(log_folder, datetime.now().strftime('events_%Y%m%d_%H%M%S.jsonl'))
+        self.path = path
+        self.file = open(path, 'w', encoding='utf8')
+        self.start = perf_counter()
+        self.write(header=dict(version=log_version, state=encode_state(ctrl.get_state()), sample_folder=sound.sample_folder,
+                               synth=sound.synths[sound.synth_ind][0] if sound.synth_ind is not None else None))
+
+    def write(self, **event):
+        self.file.write(json.dumps(event) + '\n')
+
+    def time(self):
+        return round(perf_counter() - self.start, 6)
+
+    def cc(self, cc, val, bank):
+        self.write(t=self.time(), cc=[cc, val, bank])
+
+    def key(self, key_code):
+        self.write(t=self.time(), key=key_code)
+
+    def restore(self, path):
+        self.write(t=self.time(), restore=path)  # the session folder, which the replay restores from again
+
+    def close(self):
+        self.write(t=self.time(), end=True)
+        self.file.close()
+
+
+def read_log(path):
+    # returns the header and the list of events, including the end marker
+    with open(path, encoding='utf8') as f:
+        lines = [json.loads(line) for line in f if line.strip()]
+    header = lines[0]['header']
+    header['state'] = decode_state(header['state'])
+    return header, lines[1:]
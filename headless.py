@@ -0,0 +1,127 @@
+from collections import deque
+
+import numpy as np
+from pysinewave.utilities import MIDDLE_C_FREQUENCY
+
+from controller import in_port_device, out_port_device
+
+
+class VirtualMidiIn:
+    # stand-in for rtmidi.MidiIn, fed by send_message() instead of a hardware port
+    def __init__(self):
+        self.queue = deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close_port()
+
+    def get_ports(self):
+        return [in_port_device + ' (virtual)']
+
+    def open_port(self, port=0):
+        pass
+
+    def close_port(self):
+        pass
+
+    def send_message(self, msg, delta=0):
+        self.queue.append((list(msg), delta))
+
+    def get_message(self):
+        return self.queue.popleft() if self.queue else None
+
+
+class VirtualMidiOut:
+    # stand-in for rtmidi.MidiOut, keeping the sent messages for inspection
+    def __init__(self):
+        self.messages = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close_port()
+
+    def get_ports(self):
+        return [out_port_device + ' (virtual)']
+
+    def open_port(self, port=0):
+        pass
+
+    def close_port(self):
+        pass
+
+    def send_message(self, msg):
+        self.messages.append(list(msg))
+
+
+class OfflineSineWave:
+    # drop-in replacement for pysinewave.SineWave that renders on demand with render() instead of streaming to a device
+    def __init__(self, pitch=0, pitch_per_second=12, decibels=0, decibels_per_second=1, channels=1, samplerate=44100,
+                 clip_off=False, dither_off=False, waveform=np.sin, phase_cutoff=None, db_cutoff=None):
+        self.pitch = self.goal_pitch = pitch
+        self.pitch_per_second = pitch_per_second
+        self.decibels = self.goal_decibels = decibels
+        self.decibels_per_second = decibels_per_second
+        self.channels = channels
+        self.samplerate = samplerate
+        self.clip_off = clip_off
+        self.waveform = waveform
+        self.phase_cutoff = phase_cutoff
+        self.db_cutoff = db_cutoff
+        self.phase = 0
+        self.playing = False
+        self.recording = False
+        self.record_buffer = []
+
+    def play(self):
+        self.playing = True
+
+    def stop(self):
+        self.playing = False
+
+    def set_waveform(self, waveform):
+        self.waveform = waveform
+
+    def set_pitch(self, pitch):
+        self.goal_pitch = pitch
+
+    def set_volume(self, decibels):
+        self.goal_decibels = decibels
+
+    def set_frequency(self, frequency):
+        self.set_pitch(12 * np.log2(frequency / MIDDLE_C_FREQUENCY))
+
+    def record(self, start=True, clear=False):
+        if clear:
+            self.record_buffer = []
+        self.recording = start
+
+    @staticmethod
+    def ramp(value, goal, per_second, frames, samplerate):
+        step = per_second / samplerate * np.sign(goal - value)
+        values = value + step * np.arange(1, frames + 1)
+        return np.minimum(values, goal) if step > 0 else np.maximum(values, goal)
+
+    def render(self, frames):
+        if not self.playing:
+            return np.zeros(frames)
+        pitches = self.ramp(self.pitch, self.goal_pitch, self.pitch_per_second, frames, self.samplerate)
+        decibels = self.ramp(self.decibels, self.goal_decibels, self.decibels_per_second, frames, self.samplerate)
+        self.pitch = pitches[-1]
+        self.decibels = decibels[-1]
+        x = self.phase + np.cumsum(2 * np.pi * MIDDLE_C_FREQUENCY * 2**(pitches/12) / self.samplerate)
+        self.phase = x[-1]
+        if self.phase_cutoff and self.phase > self.phase_cutoff:
+            self.phase %= 2 * np.pi
+        amplitude = 10**(decibels/20)
+        if self.db_cutoff is not None:
+            amplitude[decibels <= self.db_cutoff] = 0
+        output = self.waveform(x) * amplitude
+        if not self.clip_off:
+            output = np.clip(output, -1, 1)
+        if self.recording:
+            self.record_buffer.append(output)
+        return output
@@ -0,0 +1,144 @@
+import argparse
+from time import perf_counter
+
+import numpy as np
+
+from controller import Controller
+from headless import OfflineSineWave, VirtualMidiIn, VirtualMidiOut
+import pythotron
+from soundscape import Soundscape, samplerate
+
+
+# measures control-to-sound latency by injecting CC messages through a virtual MIDI port and rendering headlessly
+# usage: python latency.py [--synths sine smp:stretch] [--trials 20] [--blocksize 256] [--device-blocks 2]
+blocksize = 256
+trials = 20
+track = 0
+settle_blocks = 16
+max_blocks = 400
+onset_db = -60  # volume onset threshold
+analysis_frames = 4096  # trailing window for the spectral centroid, as single blocks are too short to resolve small bends
+centroid_tolerance = 0.005  # minimal relative spectral centroid change for detecting a pitch change
+centroid_std_factor = 4  # or this many standard deviations of the baseline centroid, if larger
+
+
+class Harness:
+    def __init__(self, synth_ind, blocksize=blocksize, track=track):
+        self.blocksize = blocksize
+        self.track = track
+        self.midi_in = VirtualMidiIn()
+        self.ctrl = Controller(pythotron.initial_knob_mode, midi_in=self.midi_in, midi_out=VirtualMidiOut())
+        self.sound = Soundscape(self.ctrl, pythotron.synths, pythotron.notes, pythotron.sample_folder,
+                                pythotron.synth_max_bend_semitones, pythotron.sampler_max_bend_semitones,
+                                sinewave=OfflineSineWave)
+        self.ctrl.marker_register = synth_ind
+        self.step()
+
+    def send_cc(self, cc, val):
+        self.midi_in.send_message([176, cc, val])
+
+    def step(self):
+        # one pass of the control loop followed by one rendered audio block
+        start = perf_counter()
+        self.ctrl.poll_midi()
+        self.ctrl.update_all()
+        self.sound.update()
+        self.ctrl.new_controls = {}
+        control_secs = perf_counter() - start
+        output = self.sound.tracks[self.track].render(self.blocksize)
+        if len(output.shape) > 1:
+            output = output.mean(axis=0)
+        return control_secs, output
+
+    def settle(self, blocks=settle_blocks):
+        return [self.step()[1] for _ in range(blocks)]
+
+    def measure(self, cc, val, detect):
+        # returns the seconds from injecting the message until detect(block) returns a sample index, or None on timeout
+        self.send_cc(cc, val)
+        control_secs = None
+        for i in range(max_blocks):
+            secs, output = self.step()
+            if control_secs is None:
+                control_secs = secs
+            ind = detect(output)
+            if ind is not None:
+                return control_secs + (i*self.blocksize + ind) / samplerate
+        return None
+
+    def volume_latency(self):
+        slider = self.ctrl.slider_cc + self.track
+        self.send_cc(slider, 0)
+        for _ in range(max_blocks):
+            if not np.any(self.step()[1]):
+                break
+        threshold = 10**(onset_db/20)
+
+        def detect(output):
+            loud = np.flatnonzero(abs(output) > threshold)
+            return loud[0] if len(loud) else None
+
+        return self.measure(slider, 127, detect)
+
+    @staticmethod
+    def centroid(output):
+        spectrum = abs(np.fft.rfft(output * np.hanning(len(output))))
+        return np.sum(spectrum * np.arange(len(spectrum))) / max(np.sum(spectrum), 1e-12)
+
+    def pitch_latency(self, val):
+        slider = self.ctrl.slider_cc + self.track
+        if self.ctrl.controls[slider] != 127:
+            self.send_cc(slider, 127)
+            self.settle(max_blocks)
+        trailing = np.hstack(self.settle())
+        baseline = []
+        for output in self.settle():
+            trailing = np.hstack((trailing, output))[-analysis_frames:]
+            baseline.append(self.centroid(trailing))
+        mean = np.mean(baseline)
+        tolerance = max(centroid_tolerance * mean, centroid_std_factor * np.std(baseline))
+
+        def detect(output):
+            nonlocal trailing
+            trailing = np.hstack((trailing, output))[-analysis_frames:]
+            return 0 if abs(self.centroid(trailing) - mean) > tolerance else None
+
+        return self.measure(self.ctrl.knob_cc + self.track, val, detect)
+
+
+def percentiles(latencies):
+    found = [latency for latency in latencies if latency is not None]
+    if not found:
+        return None, None, len(latencies)
+    p50, p99 = np.percentile(found, [50, 99]) * 1000
+    return p50, p99, len(latencies) - len(found)
+
+
+def run(synth_names=None, trials=trials, blocksize=blocksize, device_blocks=0):
+    device_secs = device_blocks * blocksize / samplerate
+    results = []
+    for synth_ind, synth in enumerate(pythotron.synths):
+        if synth_names and synth[0].lower() not in synth_names:
+            continue
+        harness = Harness(synth_ind, blocksize=blocksize)
+        volume = [harness.volume_latency() for _ in range(trials)]
+        pitch = []
+        for i in range(trials):
+            pitch.append(harness.pitch_latency(harness.ctrl.knob_center if i % 2 else 127))
+        for name, latencies in [('volume', volume), ('pitch', pitch)]:
+            latencies = [latency + device_secs if latency is not None else None for latency in latencies]
+            results.append((synth[0], name, *percentiles(latencies)))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Control-to-sound latency per synth')
+    parser.add_argument('--synths', nargs='*', help='synth names (default: all)')
+    parser.add_argument('--trials', type=int, default=trials)
+    parser.add_argument('--blocksize', type=int, default=blocksize)
+    parser.add_argument('--device-blocks', type=int, default=0, help='audio device buffer size in blocks, added to the measured latency')
+    args = parser.parse_args()
+    print(f'{"synth":16} {"change":6} {"p50 ms":>8} {"p99 ms":>8} {"missed":>6}')
+    for synth_name, name, p50, p99, missed in run([name.lower() for name in args.synths or []], args.trials, args.blocksize, args.device_blocks):
+        p50, p99 = ('-', '-') if p50 is None else (f'{p50:.1f}', f'{p99:.1f}')
+        print(f'{synth_name:16} {name:6} {p50:>8} {p99:>8} {missed:6}')
@@ -0,0 +1,82 @@
+import os
+
+import numpy as np
+
+from pitch_index import cache_dir
+
+
+base_frames = 64  # sample frames per peak at the finest level, and each coarser level halves the peaks
+
+
+class PeakPyramid:
+    # min/max peaks of a sample at base_frames * 2**level frames per peak, built once at load and cached on disk next to the sample
+    # any span can then be drawn at any width by reading about two peaks per column, without touching the sample
+    def __init__(self, sample, path=None):
+        self.frames = sample.shape[-1]
+        self.path = path
+        self.levels = self.load_cache() if path else None
+        if self.levels is None:
+            self.levels = self.compute(sample)
+            if path:
+                self.save_cache()
+        self.peak = max(-float(self.levels[-1][0].min()), float(self.levels[-1][1].max()))  # of the whole sample, for normalizing the display
+
+    @staticmethod
+    def compute(sample):
+        # each level is (2, peaks) with the minima and maxima over the channels
+        if not sample.shape[-1]:
+            return [np.zeros((2, 1), dtype=sample.dtype)]
+        starts = np.arange(0, sample.shape[-1], base_frames)
+        lows = np.minimum.reduceat(sample, starts, axis=-1)
+        highs = np.maximum.reduceat(sample, starts, axis=-1)
+        if sample.ndim > 1:
+            lows = lows.min(axis=0)
+            highs = highs.max(axis=0)
+        levels = [np.stack((lows, highs))]
+        while levels[-1].shape[-1] > 1:
+            level = levels[-1]
+            if level.shape[-1] % 2:
+                level = np.concatenate((level, level[:, -1:]), axis=-1)
+            levels.append(np.stack((np.minimum(level[0, ::2], level[0, 1::2]), np.maximum(level[1, ::2], level[1, 1::2]))))
+        return levels
+
+    @property
+    def cache_path(self):
+        return os.path.join(os.path.dirname(self.path), cache_dir, os.path.basename(self.path) + '.peaks.npz')
+
+    def cache_key(self):
+        return np.array([os.stat(self.path).st_mtime_ns, self.frames, base_frames])
+
+    def load_cache(self):
+        try:
+            with np.load(self.cache_path) as cache:
+                if np.array_equal(cache['key'], self.cache_key()):
+                    return [cache[f'level{i}'] for i in range(len(cache.files) - 1)]
+        except (OSError, KeyError, ValueError):
+            pass
+        return None
+
+    def save_cache(self):
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            np.savez(self.cache_path, key=self.cache_key(), **{f'level{i}': level for i, level in enumerate(self.levels)})
+        except OSError as e:
+            print(e)
+
+    def columns(self, start, end, width):
+        # the minima and maxima of width columns spanning the sample frames [start, end), from the coarsest level with a peak per column
+        frames_per_column = (end - start) / width
+        level = int(np.clip(np.log2(max(frames_per_column, 1) / base_frames), 0, len(self.levels) - 1))
+        peaks = self.levels[level]
+        peak_frames = base_frames * 2**level
+        starts = np.minimum((start + np.arange(width) * frames_per_column) // peak_frames, peaks.shape[-1] - 1).astype(int)
+        stop = min(max(-(-end // peak_frames), starts[-1] + 1), peaks.shape[-1])
+        span = peaks[:, starts[0]:stop]
+        lows = np.minimum.reduceat(span[0], starts - starts[0])
+        highs = np.maximum.reduceat(span[1], starts - starts[0])
+        # a peak that straddles a column boundary counts for both columns, so that no column misses an extreme of its frames
+        straddling = np.flatnonzero((start + np.arange(1, width) * frames_per_column) % peak_frames > 0)
+        boundary = starts[straddling + 1] - starts[0]
+        lows[straddling] = np.minimum(lows[straddling], span[0, boundary])
+        highs[straddling] = np.maximum(highs[straddling], span[1, boundary])
+        return lows, highs
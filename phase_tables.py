@@ -0,0 +1,55 @@
+import threading
+from time import sleep
+
+import numpy as np
+
+
+table_rows = 32  # unit-modulus phase vectors per spectrum size; a draw picks a row, a circular offset and a global rotation per channel
+regenerate_secs = 0.05  # one row of each unseeded table is replaced with fresh phases at this interval, so a table renews every table_rows * regenerate_secs
+
+tables = {}
+lock = threading.Lock()
+regenerator = None
+
+
+def random_phases(rng, shape, dtype):
+    return np.exp(1j * rng.uniform(0, 2 * np.pi, shape)).astype(dtype)
+
+
+class PhaseTable:
+    def __init__(self, bins, dtype, seed=None):
+        self.rows = random_phases(np.random.default_rng(seed), (table_rows, bins), dtype)
+
+    def draw(self, rng, out):
+        # fills out (channels..., bins) in place with random unit phases, replacing exp(1j * uniform(0, 2pi)) over every bin
+        bins = out.shape[-1]
+        for channel in out.reshape(-1, bins):
+            row = self.rows[rng.integers(len(self.rows))]
+            offset = rng.integers(bins)
+            channel[:bins-offset] = row[offset:]
+            channel[bins-offset:] = row[:offset]
+            channel *= np.exp(1j * rng.uniform(0, 2 * np.pi))
+        return out
+
+
+def regenerate():
+    rng = np.random.default_rng()
+    while True:
+        sleep(regenerate_secs)
+        with lock:
+            unseeded = [table for (_, _, seed), table in tables.items() if seed is None]
+        for table in unseeded:
+            table.rows[rng.integers(table_rows)] = random_phases(rng, table.rows.shape[-1], table.rows.dtype)
+
+
+def get_table(bins, dtype, seed=None):
+    # tables are shared by all tracks with the same spectrum size; seeded tables are never regenerated, so renders are reproducible
+    global regenerator
+    key = (bins, np.dtype(dtype), seed)
+    with lock:
+        if key not in tables:
+            tables[key] = PhaseTable(bins, dtype, seed=seed)
+        if seed is None and regenerator is None:
+            regenerator = threading.Thread(target=regenerate, name='phase_tables', daemon=True)
+            regenerator.start()
+        return tables[key]
@@ -0,0 +1,81 @@
+import os
+import threading
+
+import numpy as np
+
+
+cache_dir = '.pythotron_cache'  # created next to the samples
+fmin_note = 'C2'
+fmax_note = 'C7'
+hop_length = 512  # at 44.1 kHz, and scaled by whole multiples for higher sample rates, so that fmin fits in a frame
+frame_length = 2048
+background = True  # False computes on the calling thread, e.g. for deterministic replays
+
+compute_lock = threading.Lock()  # one analysis at a time, so that loading a kit does not compete with the audio for all cores
+
+
+class PitchIndex:
+    # f0 track of a sample computed once with librosa.pyin in a background thread, and cached on disk next to the sample
+    def __init__(self, sample, samplerate, path=None):
+        self.samplerate = samplerate
+        self.hop_length = hop_length * max(1, round(samplerate / 44100))
+        self.frame_length = frame_length * max(1, round(samplerate / 44100))
+        self.path = path
+        self.f0 = None
+        if background:
+            threading.Thread(target=self.compute, args=(sample,), name='pitch_index', daemon=True).start()
+        else:
+            self.compute(sample)
+
+    def __getstate__(self):
+        # render workers get the f0 track if it is ready
+        return dict(samplerate=self.samplerate, hop_length=self.hop_length, frame_length=self.frame_length, path=self.path, f0=self.f0)
+
+    @property
+    def ready(self):
+        return self.f0 is not None
+
+    @property
+    def cache_path(self):
+        return os.path.join(os.path.dirname(self.path), cache_dir, os.path.basename(self.path) + '.f0.npz')
+
+    def cache_key(self):
+        return np.array([os.stat(self.path).st_mtime_ns, self.samplerate, self.hop_length, self.frame_length]), np.array([fmin_note, fmax_note])
+
+    def load_cache(self):
+        try:
+            with np.load(self.cache_path) as cache:
+                numbers, notes = self.cache_key()
+                if np.array_equal(cache['numbers'], numbers) and np.array_equal(cache['notes'], notes):
+                    return cache['f0']
+        except (OSError, KeyError, ValueError):
+            pass
+        return None
+
+    def save_cache(self, f0):
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            numbers, notes = self.cache_key()
+            np.savez(self.cache_path, f0=f0, numbers=numbers, notes=notes)
+        except OSError as e:
+            print(e)
+
+    def compute(self, sample):
+        with compute_lock:
+            f0 = self.load_cache() if self.path else None
+            if f0 is None:
+                import librosa
+                f0 = librosa.pyin(sample if sample.ndim == 1 else sample.mean(axis=0), fmin=librosa.note_to_hz(fmin_note),
+                                  fmax=librosa.note_to_hz(fmax_note), sr=self.samplerate, frame_length=self.frame_length,
+                                  hop_length=self.hop_length)[0]
+                if self.path:
+                    self.save_cache(f0)
+        self.f0 = f0
+
+    def f0_at(self, start, end):
+        # median f0 in Hz over the voiced frames centered in sample positions [start, end), or None if unvoiced or not ready
+        if self.f0 is None:
+            return None
+        f0 = self.f0[start // self.hop_length : max(end // self.hop_length, start // self.hop_length + 1)]
+        f0 = f0[~np.isnan(f0)]
+        return float(np.median(f0)) if len(f0) else None
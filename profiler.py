@@ -0,0 +1,153 @@
+from collections import defaultdict
+from contextlib import contextmanager
+import csv
+from datetime import datetime
+import json
+from time import perf_counter
+
+import numpy as np
+
+
+enabled = True  # the overhead is two perf_counter() calls per audio callback
+hist_edges_ms = (0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200)  # callback duration histogram bin upper edges; last bin is open-ended
+xrun_gap_factor = 1.5  # a callback starting more than this many block durations after the previous one on the same track counts as an xrun
+dump_prefix = 'pythotron_profile'
+
+
+class TrackStats:
+    def __init__(self):
+        self.hist = np.zeros(len(hist_edges_ms) + 1, dtype=np.int64)
+        self.blocks = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.budget_ms = 0.0
+        self.deadline_misses = 0
+        self.gaps = 0
+        self.last_start = None
+
+    @property
+    def xruns(self):
+        return self.deadline_misses + self.gaps
+
+    def percentile(self, q):
+        # approximated by the upper edge of the histogram bin containing the percentile
+        if not self.blocks:
+            return 0.0
+        ind = int(np.searchsorted(np.cumsum(self.hist), q / 100 * self.blocks))
+        return min(hist_edges_ms[ind], self.max_ms) if ind < len(hist_edges_ms) else self.max_ms
+
+
+class Profiler:
+    def __init__(self):
+        self.enabled = enabled
+        self.last_dump = None
+        self.reset()
+
+    def reset(self):
+        self.tracks = defaultdict(TrackStats)  # (synth, track) -> TrackStats, so that switching synths starts new stats
+        self.sections = defaultdict(lambda: [0, 0.0, 0.0])  # (name, track) -> [calls, total_ms, max_ms]
+        self.gauges = defaultdict(lambda: [0, 0])  # (name, track) -> [last, max]
+
+    def wrap(self, waveform, synth, track, samplerate):
+        # times every call of a track's waveform, which is where pysinewave's audio callback spends its time
+        def func(x):
+            if not self.enabled:
+                return waveform(x)
+            start = perf_counter()
+            output = waveform(x)
+            self.add_block(synth, track, start, perf_counter() - start, x.shape[-1] / samplerate)
+            return output
+        return func
+
+    def add_block(self, synth, track, start, duration, budget):
+        stats = self.tracks[synth, track]
+        duration_ms = duration * 1000
+        stats.hist[np.searchsorted(hist_edges_ms, duration_ms)] += 1
+        stats.blocks += 1
+        stats.total_ms += duration_ms
+        stats.max_ms = max(stats.max_ms, duration_ms)
+        stats.budget_ms = budget * 1000
+        if duration > budget:
+            stats.deadline_misses += 1
+        if stats.last_start is not None and start - stats.last_start > budget * xrun_gap_factor:
+            stats.gaps += 1
+        stats.last_start = start
+
+    @contextmanager
+    def section(self, name, track=None):
+        if not self.enabled:
+            yield
+            return
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            duration_ms = (perf_counter()-start) * 1000
+            stats = self.sections[name, track]
+            stats[0] += 1
+            stats[1] += duration_ms
+            stats[2] = max(stats[2], duration_ms)
+
+    def gauge(self, name, value, track=None):
+        if self.enabled:
+            stats = self.gauges[name, track]
+            stats[0] = value
+            stats[1] = max(stats[1], value)
+
+    @staticmethod
+    def track_label(track):
+        return '-' if track is None else str(track + 1)
+
+    def track_rows(self):
+        for (synth, track), stats in sorted(self.tracks.items()):
+            yield dict(synth=synth, track=self.track_label(track), blocks=stats.blocks, mean_ms=round(stats.total_ms / max(stats.blocks, 1), 3),
+                       p50_ms=stats.percentile(50), p99_ms=stats.percentile(99), max_ms=round(stats.max_ms, 3),
+                       budget_ms=round(stats.budget_ms, 3), deadline_misses=stats.deadline_misses, gaps=stats.gaps,
+                       hist=stats.hist.tolist())
+
+    def lines(self):
+        lines = ['PROFILER synth    trk blocks  p50ms  p99ms  maxms budget xruns']
+        for row in self.track_rows():
+            lines.append(f'{row["synth"][:14]:>14} {row["track"]:>3} {row["blocks"]:6} {row["p50_ms"]:6.1f} {row["p99_ms"]:6.1f} {row["max_ms"]:6.1f} {row["budget_ms"]:6.1f} {row["deadline_misses"] + row["gaps"]:5}')
+        for (name, track), (calls, total_ms, max_ms) in sorted(self.sections.items(), key=lambda item: (item[0][0], item[0][1] if item[0][1] is not None else -1)):
+            lines.append(f'{name:>14} {self.track_label(track):>3} calls={calls} total={total_ms:.0f}ms max={max_ms:.1f}ms')
+        for (name, track), (last, max_value) in sorted(self.gauges.items(), key=lambda item: (item[0][0], item[0][1] if item[0][1] is not None else -1)):
+            lines.append(f'{name:>14} {self.track_label(track):>3} depth={last} max={max_value}')
+        if self.last_dump:
+            lines.append('dumped: ' + self.last_dump)
+        return lines
+
+    def dump(self, prefix=dump_prefix):
+        prefix += datetime.now().strftime('_%Y%m%d_%H%M%S')
+        tracks = list(self.track_rows())
+        with open(prefix + '.json', 'w', encoding='utf8') as f:
+            json.dump(dict(hist_edges_ms=hist_edges_ms, tracks=tracks,
+                           sections=[dict(name=name, track=self.track_label(track), calls=calls, total_ms=total_ms, max_ms=max_ms) for (name, track), (calls, total_ms, max_ms) in self.sections.items()],
+                           gauges=[dict(name=name, track=self.track_label(track), last=last, max=max_value) for (name, track), (last, max_value) in self.gauges.items()]),
+                      f, indent=1)
+        with open(prefix + '.csv', 'w', encoding='utf8', newline='') as f:
+            fields = [field for field in tracks[0] if field != 'hist'] if tracks else ['synth', 'track']
+            writer = csv.writer(f)
+            writer.writerow(fields + [f'<={edge}ms' for edge in hist_edges_ms] + [f'>{hist_edges_ms[-1]}ms'])
+            for row in tracks:
+                writer.writerow([row[field] for field in fields] + row['hist'])
+        self.last_dump = prefix + '.json/.csv'
+        return self.last_dump
+
+
+class PhaseTimer:
+    def __init__(self, start=None):
+        self.last = self.start = perf_counter() if start is None else start
+        self.phases = []
+
+    def mark(self, name):
+        now = perf_counter()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    def lines(self):
+        width = max(len(name) for name, _ in self.phases)
+        return [f'{name:{width}} {secs * 1000:8.1f} ms' for name, secs in self.phases] + [f'{"total":{width}} {(self.last-self.start) * 1000:8.1f} ms']
+
+
+profiler = Profiler()
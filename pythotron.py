@@ -1,6 +1,12 @@
+from time import perf_counter
+startup_time = perf_counter()  # for --profile-startup, before the other imports
+
+import argparse
 from functools import partial
 import re
-from time import sleep
+import sys
+import threading
+from time import sleep, time
 
 from asciimatics.screen import Screen
 from asciimatics.event import KeyboardEvent
@@ -8,8 +14,12 @@ from asciimatics.exceptions import ResizeScreenError
 import numpy as np
 
 from controller import Controller
+from event_log import EventRecorder
+from headless import VirtualMidiIn, VirtualMidiOut
+from profiler import PhaseTimer, profiler
+from session import restore_session, save_session
 from soundscape import Soundscape
-from synths import dsaw, chord_arp, looper, paulstretch, C, hammond_drawbar_notes, fix_notes_chords, get_note_and_chord
+from synths import dsaw, chord_arp, looper, paulstretch, C, hammond_drawbar_notes, fix_notes_chords, get_note_and_chord, kernels_warm, warmup_kernels
 
 
 synth_max_bend_semitones = 16 / 15  # == 5/3 cent per step
@@ -49,7 +59,13 @@ synths = [['sine', np.sin],
           ['ASOS-CV-M102', partial(chord_arp, chords=asos_chords, drawbars=drawbars, drawbar_notes=drawbar_notes), asos_notes],
           ]
 main_loop_delay = 0.0001
+first_block_timeout_secs = 5
+profiler_refresh_secs = 0.5
+waveform_refresh_secs = 0.1
+waveform_chars = ' ▁▂▃▄▅▆▇█'
 title = 'Pythotron'
+warmup_label = 'compiling kernels...'
+capture_label = 'capturing events...'
 max_knob_size = 21
 sample_folder = 'samples'
 
@@ -65,12 +81,140 @@ drawbar_bg_colors = [Screen.COLOUR_RED, Screen.COLOUR_RED, Screen.COLOUR_WHITE,
 note_names = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
 
 
-def main_loop(screen, ctrl, sound):
-    global show_help
+def key_char(key_code):
+    try:
+        return chr(key_code).lower()
+    except ValueError:
+        return None
+
+
+def waveform_strip(peaks, info, width):
+    # the whole sample as block characters, with the columns of the slice and of the position that the sampler reported in info
+    lows, highs = peaks.columns(0, peaks.frames, width)
+    levels = np.ceil(np.maximum(-lows, highs) / max(peaks.peak, 1e-9) * (len(waveform_chars)-1))
+    text = ''.join(waveform_chars[i] for i in np.clip(levels, 0, len(waveform_chars) - 1).astype(int))
+    if info.get('start') is None:
+        return text, None, None
+    scale = width / max(peaks.frames, 1)
+    start = int(info['start'] * scale)
+    slice_cols = start, max(int((info['start'] + abs(info['length'])) * scale), start + 1)
+    return text, slice_cols, min(int(info['pos'] * scale), width - 1)
+
+
+def is_reset_key(key_code):
+    return key_char(key_code) in ['i', 'ת', 'b', 'נ'] or key_code in [Screen.ctrl('i'), Screen.ctrl('p')]
+
+
+def toggle_capture(ctrl, sound):
+    if ctrl.recorder:
+        ctrl.recorder.close()
+        ctrl.recorder = None
+    else:
+        ctrl.recorder = EventRecorder(ctrl, sound)
+
+
+def toggle_osc(ctrl):
+    if ctrl.global_controls['osc']:
+        ctrl.stop_osc()
+        ctrl.global_controls['osc'] = False
+    else:
+        ctrl.global_controls['osc'] = ctrl.start_osc()
+
+
+def handle_key(key_code, ctrl, sound):
+    # the keys that change the controller and sound state, shared by the UI, the engine and the event log replay
+    # returns the global controls whose display needs a refresh
+    c = key_char(key_code)
+    if c in ['i', 'ת'] or key_code == Screen.ctrl('i'):
+        ctrl.reset()
+        sound.reset()
+    elif c in ['g', 'ע']:
+        ctrl.next_bank()
+    elif c in ['p', 'פ']:
+        ctrl.reset_midi()
+    elif c in ['k', 'ל']:
+        ctrl.reset_knobs()
+    elif c in ['l', 'ך']:
+        ctrl.reset_sliders()
+    elif c in ['s', 'ד']:
+        ctrl.toggle_all('s', True)
+    elif c in ['a', 'ש']:
+        ctrl.toggle_all('s', False)
+    elif c in ['f', 'x', 'כ', 'ס']:
+        if c in ['f', 'כ']:
+            ctrl.global_controls['slider_up'] = not ctrl.global_controls['slider_up']
+            ctrl.global_controls['solo_exclusive'] = ctrl.global_controls['slider_up']
+        elif c in ['x', 'ס']:
+            ctrl.global_controls['solo_exclusive'] = not ctrl.global_controls['solo_exclusive']
+            if not ctrl.global_controls['solo_exclusive']:
+                ctrl.global_controls['slider_up'] = False
+        return ['solo_exclusive', 'slider_up']
+    elif c in ['w', 'ן']:
+        ctrl.global_controls['solo_defeats_mute'] = not ctrl.global_controls['solo_defeats_mute']
+        return ['solo_defeats_mute']
+    elif c in ['m', 'צ']:
+        ctrl.toggle_all('m', True)
+    elif c in ['u', 'ו']:
+        ctrl.toggle_all('m', False)
+    elif c in ['q', 'ץ']:
+        ctrl.global_controls['mute_override'] = not ctrl.global_controls['mute_override']
+        return ['mute_override']
+    elif c in ['r', 'ר']:
+        ctrl.toggle_all('r', True)
+    elif c in ['d', 'ג']:
+        ctrl.toggle_all('r', False)
+    elif c in ['e', 'ק']:
+        ctrl.global_controls['rec_exclusive'] = not ctrl.global_controls['rec_exclusive']
+        return ['rec_exclusive']
+    elif c in ['z', 'ז']:
+        ctrl.toggle_all('msr', False)
+    elif c and '0' <= c <= '9':
+        num = (int(c) - 1) % 10
+        if num < len(synths):
+            ctrl.marker_register = num
+    elif c == '-':
+        ctrl.transport['marker_rew'] = True
+        ctrl.new_transport['marker_rew'] = False
+    elif c in ['+', '=']:
+        ctrl.transport['marker_ff'] = True
+        ctrl.new_transport['marker_ff'] = False
+    elif key_code == Screen.KEY_LEFT:
+        ctrl.transport['rew'] = True
+        ctrl.new_transport['rew'] = False
+    elif key_code == Screen.KEY_RIGHT:
+        ctrl.transport['ff'] = True
+        ctrl.new_transport['ff'] = False
+    elif key_code == Screen.KEY_DOWN:
+        ctrl.transport['track_rew'] = True
+        ctrl.new_transport['track_rew'] = False
+    elif key_code == Screen.KEY_UP:
+        ctrl.transport['track_ff'] = True
+        ctrl.new_transport['track_ff'] = False
+    elif c == '/':
+        ctrl.new_transport['set'] = not ctrl.transport['set']
+    elif key_code == Screen.ctrl('p'):
+        ctrl.reset()
+        sound.reset()
+        sound.update_synth(name_or_num='ASOS-CV-M102')
+        sound.update_sample(name_or_num='3_ah500')
+        ctrl.track_register['syn'] = 1  # notes, chords
+        ctrl.transport_register['syn'] = 1  # harmonizer
+        ctrl.new_transport['set'] = True  # autotune
+        ctrl.global_controls['slider_up'] = True
+        ctrl.global_controls['solo_exclusive'] = True
+    return []
+
+
+def main_loop(screen, ctrl, sound, remote=False):
+    # with remote, sound is an engine.EngineClient, which mirrors the engine state into ctrl and gets the keys that the UI does not handle
+    global show_help, show_profiler, show_waveforms
     slider_size = screen.height // 2
     knob_size = min(screen.height // 2, max_knob_size)
     if not knob_size % 2:
         knob_size += 1
+    # the waveform strips go to the rows between the knobs with their labels and the sliders, where no control is drawn
+    waveform_top = max(int(int((knob_size-1)/4 + 1) - knob_size/4 + 4 + screen.height/4), int((knob_size-1)/2 - knob_size/4 + screen.height/4)) + 1
+    waveform_bottom = int(slider_size/2 - (slider_size-1) + 1.5*screen.height/2 - (slider_size/2 >= screen.height/4))
     screen.set_title(title)
     next_key_code = None
 
@@ -81,13 +225,33 @@ def main_loop(screen, ctrl, sound):
         second_disp = None
 
     reset_disp()
-
-    def reset():
-        global show_help
+    show_warmup = False
+    show_capture = False
+    profiler_lines = []
+    profiler_refresh_time = 0
+    waveform_rows = []
+    waveform_refresh_time = 0
+
+    def clear_profiler():
+        nonlocal profiler_lines
+        for i, line in enumerate(profiler_lines):
+            screen.print_at(' ' * len(line), 0, screen.height - len(profiler_lines) + i, bg=bg_color)
+        profiler_lines = []
+
+    def clear_waveforms():
+        nonlocal waveform_rows
+        for y in waveform_rows:
+            screen.print_at(' ' * screen.width, 0, y, bg=bg_color)
+        waveform_rows = []
+
+    def reset_ui():
+        global show_help, show_profiler, show_waveforms
         show_help = False
+        show_profiler = False
+        show_waveforms = False
+        clear_profiler()
+        clear_waveforms()
         reset_disp()
-        ctrl.reset()
-        sound.reset()
 
     def flip_display_global_controls(control=None, flip=True):
         nonlocal screen_refresh
@@ -110,15 +274,19 @@ def main_loop(screen, ctrl, sound):
         if screen.has_resized():
             raise ResizeScreenError('Screen resized')
 
-        msg = ctrl.midi_in.get_message()
-        while msg:
-            ctrl.update_single(*msg[0][1:])
-            msg = ctrl.midi_in.get_message()
+        if remote:
+            changed_controls = sound.poll()
+        else:
+            changed_controls = []
+            profiler.gauge('midi', ctrl.poll_midi())
+            profiler.gauge('osc', ctrl.poll_osc())
 
-        ctrl.update_all()
-        sound.update()
+            ctrl.update_all()
+            sound.update()
 
         screen_refresh = bool(ctrl.new_controls)
+        for control in changed_controls:
+            flip_display_global_controls(control, flip=False)
 
         if second_disp != sound.second_disp or synth_disp != sound.synth_disp:
             screen_refresh = True
@@ -144,12 +312,16 @@ def main_loop(screen, ctrl, sound):
 
         ctrl.refresh_sliders_of_knobs()
         for cc, v in reversed(list(ctrl.new_controls.items())):
-            k = cc - ctrl.slider_cc
-            is_slider = 0 <= k < ctrl.num_controls
+            k = ctrl.cc_track(cc, ctrl.slider_cc)
+            is_slider = k is not None
+            if not is_slider:
+                k = ctrl.cc_track(cc, ctrl.knob_cc)
+            if k not in ctrl.bank_tracks():
+                continue
+            column = k % ctrl.num_controls
             if is_slider:
                 control_size = slider_size
             else:
-                k = cc - ctrl.knob_cc
                 control_size = knob_size
                 if sound.hasattr_partial(synths[sound.synth_ind][1], 'show_track_numbers') and not ctrl.transport.get('set'):
                     label = str(k + 1).rjust(2)
@@ -166,7 +338,7 @@ def main_loop(screen, ctrl, sound):
 
                 for i, char in enumerate(label.ljust(6)):
                     screen.print_at(char,
-                                    int((k+0.5) * screen.width / ctrl.num_controls),
+                                    int((column+0.5) * screen.width / ctrl.num_controls),
                                     int(int((knob_size-1)/4 + 1) - knob_size/4 + i - 1 + screen.height/4),
                                     colour=solo_color if 's' in ctrl.states and ctrl.states['s'][k] else fg_color,
                                     attr=Screen.A_REVERSE if char != ' ' else Screen.A_NORMAL,
@@ -204,7 +376,7 @@ def main_loop(screen, ctrl, sound):
 
                 x = abs(j - (knob_size-1)/2) - (knob_size-1)/4 - 1
                 screen.print_at(text,
-                                int((k+0.5)*screen.width/ctrl.num_controls - 1 + 2*(j-(knob_size-1)/2+(1 if j < (knob_size-1) / 2 else -1)*(abs(x)*2+1)*(x >= 0))*(not is_slider)),
+                                int((column+0.5)*screen.width/ctrl.num_controls - 1 + 2*(j-(knob_size-1)/2+(1 if j < (knob_size-1) / 2 else -1)*(abs(x)*2+1)*(x >= 0))*(not is_slider)),
                                 int(((slider_size/2 - j) if is_slider else (abs(j - (knob_size-1)/2) - knob_size/4)) + (is_slider+0.5)*screen.height/2 - (is_slider and slider_size / 2 >= screen.height / 4)),
                                 colour=solo_color if 's' in ctrl.states and ctrl.states['s'][k] else fg_color,
                                 attr=Screen.A_NORMAL if 'm' in ctrl.states and ctrl.states['m'][k] else Screen.A_BOLD,
@@ -212,6 +384,22 @@ def main_loop(screen, ctrl, sound):
 
         flip_display_global_controls()
 
+        if show_warmup != (not (sound.warm if remote else kernels_warm.is_set())):
+            show_warmup = not show_warmup
+            screen_refresh = True
+            if show_warmup:
+                screen.print_at(warmup_label, screen.width - len(warmup_label), screen.height - 1, colour=overlay_fg_color, attr=overlay_attr, bg=overlay_bg_color)
+            else:
+                screen.print_at(' ' * len(warmup_label), screen.width - len(warmup_label), screen.height - 1, bg=bg_color)
+
+        if show_capture != (sound.capture if remote else bool(ctrl.recorder)):
+            show_capture = not show_capture
+            screen_refresh = True
+            if show_capture:
+                screen.print_at(capture_label, screen.width - len(capture_label), screen.height - 2, colour=overlay_fg_color, attr=overlay_attr, bg=overlay_bg_color)
+            else:
+                screen.print_at(' ' * len(capture_label), screen.width - len(capture_label), screen.height - 2, bg=bg_color)
+
         help_x = max(0, (screen.width-len(max(help_text, key=len))) // 2)
         help_y = max(0, (screen.height-len(help_text)) // 2)
         if show_help:
@@ -219,6 +407,37 @@ def main_loop(screen, ctrl, sound):
             for i, line in enumerate(help_text):
                 screen.print_at(line, help_x, help_y + i, colour=overlay_fg_color, attr=overlay_attr, bg=overlay_bg_color)
 
+        if show_profiler and time() - profiler_refresh_time > profiler_refresh_secs:
+            screen_refresh = True
+            profiler_refresh_time = time()
+            lines = sound.profiler_lines if remote else profiler.lines()
+            width = max(len(line) for line in profiler_lines + lines)
+            clear_profiler()
+            profiler_lines = [line.ljust(width) for line in lines]
+            for i, line in enumerate(profiler_lines):
+                screen.print_at(line, 0, screen.height - len(profiler_lines) + i, colour=overlay_fg_color, attr=overlay_attr, bg=overlay_bg_color)
+
+        if show_waveforms and time() - waveform_refresh_time > waveform_refresh_secs:
+            screen_refresh = True
+            waveform_refresh_time = time()
+            clear_waveforms()
+            y = waveform_top
+            for k in ctrl.bank_tracks():
+                if y >= waveform_bottom:  # the first sampler tracks of the bank, as many as fit
+                    break
+                peaks = sound.track_peaks(k)
+                if peaks is None:
+                    continue
+                label = str(k + 1).rjust(2) + ' '
+                text, slice_cols, pos_col = waveform_strip(peaks, sound.track_info[k], screen.width - len(label))
+                screen.print_at(label, 0, y, colour=overlay_fg_color, attr=overlay_attr, bg=overlay_bg_color)
+                screen.print_at(text, len(label), y, colour=fg_color, bg=bg_color)
+                if slice_cols:
+                    screen.print_at(text[slice_cols[0]:slice_cols[1]], len(label) + slice_cols[0], y, colour=overlay_fg_color, attr=overlay_attr, bg=overlay_bg_color)
+                    screen.print_at(text[pos_col], len(label) + pos_col, y, colour=solo_color, attr=Screen.A_REVERSE, bg=bg_color)
+                waveform_rows.append(y)
+                y += 1
+
         ctrl.new_controls = {}
 
         if next_key_code is not None:
@@ -227,11 +446,7 @@ def main_loop(screen, ctrl, sound):
         else:
             ev = screen.get_event()
         if isinstance(ev, KeyboardEvent):  # note: Hebrew keys assume SI 1452-2 / 1452-3 layout
-            c = None
-            try:
-                c = chr(ev.key_code).lower()
-            except ValueError:
-                pass
+            c = key_char(ev.key_code)
             if c in ['h', 'י']:
                 show_help = not show_help
                 if not show_help:
@@ -239,92 +454,62 @@ def main_loop(screen, ctrl, sound):
                     ctrl.refresh_for_display()
                     for i, line in enumerate(help_text):
                         screen.print_at(re.sub(r'\S', ' ', line), help_x, help_y + i, bg=bg_color)
-            elif c in ['i', 'ת'] or ev.key_code == Screen.ctrl('i'):
-                reset()
-            elif c in ['p', 'פ']:
-                ctrl.reset_midi()
-            elif c in ['k', 'ל']:
-                ctrl.reset_knobs()
-            elif c in ['l', 'ך']:
-                ctrl.reset_sliders()
-            elif c in ['s', 'ד']:
-                ctrl.toggle_all('s', True)
-            elif c in ['a', 'ש']:
-                ctrl.toggle_all('s', False)
-            elif c in ['f', 'x', 'כ', 'ס']:
-                if c in ['f', 'כ']:
-                    ctrl.global_controls['slider_up'] = not ctrl.global_controls['slider_up']
-                    ctrl.global_controls['solo_exclusive'] = ctrl.global_controls['slider_up']
-                elif c in ['x', 'ס']:
-                    ctrl.global_controls['solo_exclusive'] = not ctrl.global_controls['solo_exclusive']
-                    if not ctrl.global_controls['solo_exclusive']:
-                        ctrl.global_controls['slider_up'] = False
-                flip_display_global_controls('solo_exclusive', flip=False)
-                flip_display_global_controls('slider_up', flip=False)
-            elif c in ['w', 'ן']:
-                flip_display_global_controls('solo_defeats_mute')
-            elif c in ['m', 'צ']:
-                ctrl.toggle_all('m', True)
-            elif c in ['u', 'ו']:
-                ctrl.toggle_all('m', False)
-            elif c in ['q', 'ץ']:
-                flip_display_global_controls('mute_override')
-            elif c in ['r', 'ר']:
-                ctrl.toggle_all('r', True)
-            elif c in ['d', 'ג']:
-                ctrl.toggle_all('r', False)
-            elif c in ['e', 'ק']:
-                flip_display_global_controls('rec_exclusive')
-            elif c in ['z', 'ז']:
-                ctrl.toggle_all('msr', False)
-            elif c in ['o', 'ם']:
-                flip_display_global_controls('osc')
-            elif c and '0' <= c <= '9':
-                num = (int(c) - 1) % 10
-                if num < len(synths):
-                    ctrl.marker_register = num
-            elif c == '-':
-                ctrl.transport['marker_rew'] = True
-                ctrl.new_transport['marker_rew'] = False
-            elif c in ['+', '=']:
-                ctrl.transport['marker_ff'] = True
-                ctrl.new_transport['marker_ff'] = False
-            elif ev.key_code == Screen.KEY_LEFT:
-                ctrl.transport['rew'] = True
-                ctrl.new_transport['rew'] = False
-            elif ev.key_code == Screen.KEY_RIGHT:
-                ctrl.transport['ff'] = True
-                ctrl.new_transport['ff'] = False
-            elif ev.key_code == Screen.KEY_DOWN:
-                ctrl.transport['track_rew'] = True
-                ctrl.new_transport['track_rew'] = False
-            elif ev.key_code == Screen.KEY_UP:
-                ctrl.transport['track_ff'] = True
-                ctrl.new_transport['track_ff'] = False
-            elif c == '/':
-                ctrl.new_transport['set'] = not ctrl.transport['set']
+            elif c in ['v', 'ה']:
+                show_profiler = not show_profiler
+                if not show_profiler:
+                    screen_refresh = True
+                    clear_profiler()
+                    ctrl.refresh_for_display()
+                profiler_refresh_time = 0
+            elif c in ['y', 'ט']:
+                show_waveforms = not show_waveforms
+                if not show_waveforms:
+                    screen_refresh = True
+                    clear_waveforms()
+                    ctrl.refresh_for_display()
+                waveform_refresh_time = 0
             elif ev.key_code == Screen.ctrl('q'):
+                if ctrl.recorder:
+                    ctrl.recorder.close()
                 return
-            elif ev.key_code == Screen.ctrl('p'):
-                reset()
-                sound.update_synth(name_or_num='ASOS-CV-M102')
-                sound.update_sample(name_or_num='3_ah500')
-                ctrl.track_register['syn'] = 1  # notes, chords
-                ctrl.transport_register['syn'] = 1  # harmonizer
-                ctrl.new_transport['set'] = True  # autotune
-                ctrl.global_controls['slider_up'] = True
-                ctrl.global_controls['solo_exclusive'] = True
+            elif remote:
+                if is_reset_key(ev.key_code):
+                    reset_ui()
+                sound.send_key(ev.key_code)
+            elif c in ['j', 'ח']:
+                profiler.dump()
+                profiler_refresh_time = 0
+            elif c in ['c', 'ב']:
+                toggle_capture(ctrl, sound)
+            elif c in ['o', 'ם']:
+                toggle_osc(ctrl)
+                flip_display_global_controls('osc', flip=False)
+            elif c in ['n', 'מ']:
+                save_session(ctrl, sound)
+            elif c in ['b', 'נ']:
+                reset_ui()
+                if not restore_session(ctrl, sound):
+                    ctrl.refresh_for_display()
+            else:
+                if is_reset_key(ev.key_code):
+                    reset_ui()
+                if ctrl.recorder:
+                    ctrl.recorder.key(ev.key_code)
+                for control in handle_key(ev.key_code, ctrl, sound):
+                    flip_display_global_controls(control, flip=False)
 
         if screen_refresh:
             screen.refresh()
         sleep(main_loop_delay)
 
 
-# unused: y, g, j, c, v, b, n
+# unused: t
 # avoid: ENTER, ESC if running in pycharm terminal
 with open('help.txt', encoding='utf8') as f:
     help_text = [line.strip() for line in f.read().strip().splitlines()]
 show_help = False
+show_profiler = False
+show_waveforms = False
 
 help_keys = [line[0].lower() for line in help_text if len(line) > 1 and line[1] in (' ', '\t')]
 synth_names = [synth[0].lower() for synth in synths]
@@ -333,23 +518,64 @@ for validate in synth_names, synth_funcs, help_keys:
     dupes = {x for x in validate if validate.count(x) > 1}
     assert not dupes, sorted(dupes)
 
+note_names += [x.lower() for x in note_names]
 initial_knob_mode = synths[0][0].lower().startswith('smp')
-controller = Controller(initial_knob_mode)
-soundscape = Soundscape(controller, synths, notes, sample_folder, synth_max_bend_semitones, sampler_max_bend_semitones)
 
-for validate in [notes, asos_notes]:
-    assert all(len(n) >= controller.num_controls for n in validate), (validate, [len(n) for n in validate], controller.num_controls)
-note_names += [x.lower() for x in note_names]
 
-with controller.midi_in, controller.midi_out:
-    while True:
-        try:
-            Screen.wrapper(main_loop, arguments=[controller, soundscape])
-            break
-        except ResizeScreenError:
-            controller.refresh_for_display()
-        except BaseException:
-            if controller.osc_server:
-                controller.osc_server.shutdown()
-            soundscape.kill_sound()
-            raise
+def profile_startup(timer, ctrl, sound):
+    # runs the first control loop pass without the UI, waits for the first audio callback and prints the timings
+    ctrl.poll_midi()
+    ctrl.update_all()
+    timer.mark('first control pass')
+    sound.update()
+    timer.mark('first sound update (sample decode, synth build, streams)')
+    start = time()
+    while not profiler.tracks and time() - start < first_block_timeout_secs:
+        sleep(main_loop_delay)
+    timer.mark('first audio block' if profiler.tracks else 'first audio block (timed out)')
+    kernels_warm.wait()
+    timer.mark('numba kernel warmup (remainder, runs in the background)')
+    sound.kill_sound()
+    print('\n'.join(timer.lines()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=title)
+    parser.add_argument('--profile-startup', action='store_true', help='print a per-phase startup timing breakdown and exit')
+    parser.add_argument('--connect', nargs='?', const='pythotron.sock', metavar='SOCKET', help='run only the UI, for an engine started with engine.py')
+    parser.add_argument('--restore', nargs='?', const='', metavar='SESSION', help='restore a session saved with "n" (default: the latest)')
+    args = parser.parse_args()
+
+    startup_timer = PhaseTimer(startup_time)
+    startup_timer.mark('imports and config')
+    if args.connect:
+        from engine import EngineClient
+        controller = Controller(initial_knob_mode, midi_in=VirtualMidiIn(), midi_out=VirtualMidiOut())  # MIDI goes to the engine
+        soundscape = EngineClient(controller, args.connect)
+    else:
+        threading.Thread(target=warmup_kernels, daemon=True).start()
+        controller = Controller(initial_knob_mode)
+        startup_timer.mark('controller (MIDI ports)')
+        soundscape = Soundscape(controller, synths, notes, sample_folder, synth_max_bend_semitones, sampler_max_bend_semitones)
+        startup_timer.mark('soundscape')
+        if args.restore is not None:
+            restore_session(controller, soundscape, args.restore)
+            startup_timer.mark('session restore')
+    if args.profile_startup and not args.connect:
+        profile_startup(startup_timer, controller, soundscape)
+        sys.exit()
+
+    for validate in [notes, asos_notes]:
+        assert all(len(n) >= controller.num_controls for n in validate), (validate, [len(n) for n in validate], controller.num_controls)
+
+    with controller.midi_in, controller.midi_out:
+        while True:
+            try:
+                Screen.wrapper(main_loop, arguments=[controller, soundscape, bool(args.connect)])
+                break
+            except ResizeScreenError:
+                controller.refresh_for_display()
+            except BaseException:
+                controller.stop_osc()
+                soundscape.kill_sound()
+                raise
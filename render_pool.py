@@ -0,0 +1,203 @@
+import atexit
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+import pickle
+from time import sleep, time
+
+import numpy as np
+
+from profiler import profiler
+from synths import dtype
+
+
+processes = 0  # render sampler tracks in this many worker processes instead of the audio callbacks (0 == off)
+block_frames = 512
+ring_blocks = 4  # buffered blocks per track, which adds up to ring_blocks * block_frames of control latency
+sync_secs = 0.005  # minimal interval for sending the controller state to the workers
+idle_secs = 0.001
+WRITE, READ, SEEK = 0, 1, 2  # the counters of each voice; SEEK is the clock position to resume from, written by the reader
+
+
+def share(array):
+    shm = SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def attach(spec, readonly=True):
+    name, shape, dtype = spec
+    shm = SharedMemory(name=name)  # spawned workers share the resource tracker of the main process, which owns and unlinks the blocks
+    array = np.ndarray(shape, dtype, buffer=shm.buf)
+    array.flags.writeable = not readonly
+    return shm, array
+
+
+def worker_main(conn, ring_spec, counters_spec, initial_knob_mode, samplerate):
+    # renders the assigned tracks ahead into their ring buffers, with a local controller mirroring the main process state
+    from controller import Controller
+    from headless import VirtualMidiIn, VirtualMidiOut
+    from transport_clock import TransportClock
+
+    ring_shm, ring = attach(ring_spec, readonly=False)  # the handles must outlive the arrays, which are only views of their buffers
+    counters_shm, counters = attach(counters_spec, readonly=False)
+    shms = {}
+    ring_frames = ring.shape[-1]
+    ctrl = Controller(initial_knob_mode, midi_in=VirtualMidiIn(), midi_out=VirtualMidiOut())
+    clock = TransportClock(ring.shape[0], samplerate)  # counts the rendered frames, which run ahead of the main process by the buffered blocks
+    waveforms = {}
+    seeks = counters[:, SEEK].copy()  # the resume positions applied so far
+    x = np.zeros(block_frames)
+
+    def attach_sample(spec):
+        if spec[0] not in shms:
+            shms[spec[0]] = attach(spec)
+        return shms[spec[0]][1]
+
+    def release(name):
+        shm, array = shms.pop(name)
+        del array
+        try:
+            shm.close()
+        except BufferError:  # still viewed by a dropped waveform that was not collected yet, so the mapping goes with it
+            pass
+
+    while True:
+        while conn.poll():
+            cmd, *args = conn.recv()
+            if cmd == 'state':
+                ctrl.set_state(pickle.loads(args[0]))
+            elif cmd == 'synth':
+                synth, sample_specs, tracks, frames, kwargs = args
+                try:
+                    sample = [attach_sample(spec) for spec in sample_specs] if isinstance(sample_specs, list) else attach_sample(sample_specs)
+                except FileNotFoundError:  # the sample was replaced before we got here, so a newer assignment is already queued
+                    continue
+                waveforms = {k: clock.wrap(synth(track=track, ctrl=ctrl, sample=sample, samplerate=samplerate, clock=clock.voices[k], **kwargs), k)
+                             for k, track in tracks.items()}
+                for k in waveforms:
+                    counters[k, WRITE] = counters[k, READ]
+                    if frames is not None:
+                        clock.frames[k] = frames[k]  # the emptied ring resumes where the main process is
+                names = {spec[0] for spec in (sample_specs if isinstance(sample_specs, list) else [sample_specs])}
+                for name in list(shms):
+                    if name not in names:
+                        release(name)
+            elif cmd == 'stop':
+                waveforms = {}
+            elif cmd == 'exit':
+                return
+        busy = False
+        for k, waveform in waveforms.items():
+            if counters[k, SEEK] != seeks[k]:  # the voice resumed after being skipped, and its reader dropped the blocks rendered ahead
+                seeks[k] = clock.frames[k] = counters[k, SEEK]
+            write = counters[k, WRITE]
+            if write - counters[k, READ] <= ring_frames - block_frames:
+                ring[k, :, np.arange(write, write + block_frames) % ring_frames] = np.atleast_2d(waveform(x)).T
+                counters[k, WRITE] = write + block_frames
+                busy = True
+        if not busy:
+            sleep(idle_secs)
+
+
+class RenderPool:
+    # runs sampler tracks in worker processes that write into shared memory ring buffers, which the audio callbacks only copy from
+    # only for synths whose output does not depend on the phase input (skip_external_pitch_control), as the workers render ahead of it
+    def __init__(self, num_voices, channels, samplerate, initial_knob_mode, processes=None):
+        self.channels = channels
+        self.ring_shm, ring_spec = share(np.zeros((num_voices, channels, block_frames * ring_blocks), dtype=dtype))
+        self.counters_shm, counters_spec = share(np.zeros((num_voices, 3), dtype=np.int64))
+        self.ring = np.ndarray(ring_spec[1], ring_spec[2], buffer=self.ring_shm.buf)
+        self.counters = np.ndarray(counters_spec[1], counters_spec[2], buffer=self.counters_shm.buf)
+        context = get_context('spawn')
+        self.conns = []
+        self.workers = []
+        for _ in range(processes or globals()['processes']):
+            conn, child_conn = context.Pipe()
+            worker = context.Process(target=worker_main, args=(child_conn, ring_spec, counters_spec, initial_knob_mode, samplerate), daemon=True)
+            worker.start()
+            self.conns.append(conn)
+            self.workers.append(worker)
+        self.sample_version = None
+        self.sample_shms = []
+        self.sample_specs = None
+        self.state = None
+        self.sync_time = 0
+        atexit.register(self.close)
+
+    def share_sample(self, sample, version):
+        # samples are copied once into shared memory and mapped read-only by the workers
+        if version == self.sample_version:
+            return
+        for shm in self.sample_shms:  # the workers keep their mappings of the previous sample until they switch
+            shm.close()
+            shm.unlink()
+        self.sample_shms = []
+        shared = {}
+        specs = []
+        for array in sample if isinstance(sample, list) else [sample]:
+            if id(array) not in shared:
+                shm, shared[id(array)] = share(array)
+                self.sample_shms.append(shm)
+            specs.append(shared[id(array)])
+        self.sample_specs = specs if isinstance(sample, list) else specs[0]
+        self.sample_version = version
+
+    def assign(self, synth, sample, version, tracks, frames=None, **kwargs):
+        # tracks maps each voice to the track argument of the synth factory, which also gets kwargs; returns the waveforms that read the voices' ring buffers
+        # frames are the transport clock positions of the voices
+        self.share_sample(sample, version)
+        for i, conn in enumerate(self.conns):
+            conn.send(('synth', synth, self.sample_specs, {k: track for k, track in tracks.items() if k % len(self.conns) == i}, frames, kwargs))
+        return [self.reader(k) for k in tracks]
+
+    def stop(self):
+        for conn in self.conns:
+            conn.send(('stop',))
+
+    def sync(self, ctrl):
+        if time() - self.sync_time < sync_secs:
+            return
+        self.sync_time = time()
+        state = pickle.dumps(ctrl.get_state())
+        if state != self.state:
+            self.state = state
+            for conn in self.conns:
+                conn.send(('state', state))
+
+    def reader(self, k):
+        ring = self.ring[k]
+        counters = self.counters[k]
+
+        def func(x):
+            n = x.shape[-1]
+            read = counters[READ]
+            available = min(counters[WRITE] - read, n)
+            output = np.zeros((self.channels, n), dtype=dtype)
+            if available > 0:
+                output[:, :available] = ring[:, np.arange(read, read + available) % ring.shape[-1]]
+                counters[READ] = read + available
+            profiler.gauge('ring', counters[WRITE] - counters[READ], k)
+            return output[0] if self.channels == 1 else output
+
+        def resume(frames):
+            # the worker rendered ahead while the voice was skipped, so the buffered blocks are stale and it continues from the voice's position
+            counters[SEEK] = frames
+            counters[READ] = counters[WRITE]
+        func.resume = resume
+        return func
+
+    def close(self):
+        for conn in self.conns:
+            try:
+                conn.send(('exit',))
+            except (BrokenPipeError, OSError):
+                pass
+        for worker in self.workers:
+            worker.join(timeout=1)
+        self.conns = []
+        self.workers = []
+        for shm in [self.ring_shm, self.counters_shm] + self.sample_shms:
+            shm.close()
+            shm.unlink()
+        self.sample_shms = []
+        atexit.unregister(self.close)
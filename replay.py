@@ -0,0 +1,118 @@
+import argparse
+import hashlib
+import sys
+from time import perf_counter
+
+import numpy as np
+
+from controller import Controller
+from event_log import read_log
+from headless import OfflineSineWave, VirtualMidiIn, VirtualMidiOut
+import pitch_index
+import pythotron
+import render_pool
+from session import restore_session
+from soundscape import Soundscape, samplerate
+import synth_pool
+import synths
+import texture_cache
+import voices
+
+
+# replays an event log captured with "c" through the controller and the soundscape, rendering all tracks headlessly as fast as possible
+# reports the throughput, the control pass and block render times, and a digest of the output for regression tests
+# usage: python replay.py event_logs/events_20240101_120000.jsonl [--blocksize 256] [--expect DIGEST] [--output replay.wav]
+blocksize = 256
+seed = 0  # random_seed of the synths unless set, so that the digest is reproducible
+digest_bits = 16  # the output is quantized before hashing, so that last-bit differences between FFT builds rarely change the digest
+
+
+def deterministic():
+    # background work and load dependent decisions would make the output depend on timing, so the replay does them inline
+    if synths.random_seed is None:
+        synths.random_seed = seed
+    render_pool.processes = 0
+    synth_pool.background = False
+    texture_cache.background = False
+    pitch_index.background = False
+    voices.cpu_budget = float('inf')
+
+
+class Replay:
+    def __init__(self, path, blocksize=blocksize):
+        self.header, self.events = read_log(path)
+        self.blocksize = blocksize
+        self.frames = 0
+        deterministic()
+        self.ctrl = Controller(pythotron.initial_knob_mode, midi_in=VirtualMidiIn(), midi_out=VirtualMidiOut())
+        self.sound = Soundscape(self.ctrl, pythotron.synths, pythotron.notes, self.header['sample_folder'],
+                                pythotron.synth_max_bend_semitones, pythotron.sampler_max_bend_semitones,
+                                sinewave=OfflineSineWave)
+        self.ctrl.set_state(self.header['state'])
+
+    def dispatch(self, event):
+        if 'cc' in event:
+            self.ctrl.update_single(*event['cc'])
+        elif 'key' in event:
+            pythotron.handle_key(event['key'], self.ctrl, self.sound)
+        elif 'restore' in event:
+            restore_session(self.ctrl, self.sound, event['restore'])
+
+    def run(self):
+        # returns the output (channels, frames), the control pass times and the block render times
+        outputs = []
+        control_secs = []
+        render_secs = []
+        i = 0
+        while i < len(self.events):
+            start = perf_counter()
+            while i < len(self.events) and self.events[i]['t'] <= self.frames / samplerate:
+                self.dispatch(self.events[i])
+                i += 1
+            self.ctrl.update_all()
+            self.sound.update()
+            self.ctrl.new_controls = {}
+            control_secs.append(perf_counter() - start)
+            start = perf_counter()
+            output = np.zeros((1, self.blocksize))
+            for track in self.sound.tracks:
+                output = output + track.render(self.blocksize)
+            render_secs.append(perf_counter() - start)
+            outputs.append(output.astype(synths.dtype))
+            self.frames += self.blocksize
+        self.sound.kill_sound()
+        channels = max(len(output) for output in outputs)  # mono blocks are spread over both channels if a stereo sample came up
+        return np.hstack([np.broadcast_to(output, (channels, self.blocksize)) for output in outputs]), np.array(control_secs), np.array(render_secs)
+
+
+def digest(output):
+    scale = 2**(digest_bits-1) - 1
+    quantized = np.round(np.clip(output, -1, 1) * scale).astype('<i4')
+    return hashlib.sha1(quantized.tobytes()).hexdigest()[:16]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay a captured event log headlessly')
+    parser.add_argument('log')
+    parser.add_argument('--blocksize', type=int, default=blocksize)
+    parser.add_argument('--expect', help='exit with an error if the output digest differs')
+    parser.add_argument('--output', help='write the rendered output to this wav file')
+    args = parser.parse_args()
+    replay = Replay(args.log, blocksize=args.blocksize)
+    start = perf_counter()
+    output, control_secs, render_secs = replay.run()
+    wall_secs = perf_counter() - start
+    audio_secs = output.shape[-1] / samplerate
+    block_ms = args.blocksize / samplerate * 1000
+    print(f'events: {len(replay.events) - 1}, audio: {audio_secs:.1f}s, wall: {wall_secs:.1f}s, realtime factor: {audio_secs / wall_secs:.1f}x')
+    for name, secs in [('control pass', control_secs), ('block render', render_secs)]:
+        p50, p99 = np.percentile(secs, [50, 99]) * 1000
+        print(f'{name:12} p50 {p50:.2f}ms p99 {p99:.2f}ms max {secs.max() * 1000:.2f}ms (block {block_ms:.2f}ms)')
+    result = digest(output)
+    print('digest:', result)
+    if args.output:
+        import soundfile
+        soundfile.write(args.output, output.T, samplerate)
+    if args.expect and args.expect != result:
+        print('expected digest:', args.expect)
+        sys.exit(1)
@@ -0,0 +1,71 @@
+from datetime import datetime
+from glob import glob
+import json
+import os
+
+import numpy as np
+
+from event_log import decode_state, encode_state
+
+
+session_folder = 'sessions'
+session_version = 1
+state_file = 'session.json'
+record_file = 'record_buffer.npy'  # uncompressed, so that restoring maps it instead of reading it
+
+
+def save_session(ctrl, sound, path=None):
+    # saves the controller state and the sample reference as JSON and the live-looper recording as .npy, in a folder per session
+    # the state file is written last and atomically, so that a crash while saving leaves no session that looks complete
+    if path is None:
+        path = os.path.join(session_folder, datetime.now().strftime('session_%Y%m%d_%H%M%S'))
+    os.makedirs(path, exist_ok=True)
+    recording = any(track.record_buffer for track in sound.tracks[:ctrl.num_tracks])
+    if recording:
+        np.save(os.path.join(path, record_file), sound.record_buffer)
+    tmp_path = os.path.join(path, state_file + '.tmp')
+    with open(tmp_path, 'w', encoding='utf8') as f:
+        json.dump(dict(version=session_version, state=encode_state(ctrl.get_state()), sample=sound.sample_name, recording=recording), f)
+    os.replace(tmp_path, os.path.join(path, state_file))
+    return path
+
+
+def latest_session():
+    paths = sorted(glob(os.path.join(session_folder, '*', state_file)))
+    return os.path.dirname(paths[-1]) if paths else None
+
+
+def restore_session(ctrl, sound, path=None):
+    # restores the given or the latest session and returns its path, or None if there is none
+    # the recording comes back as after STOP: it can be played and looped until the next recording clears it
+    path = path or latest_session()
+    if path is None:
+        return None
+    with open(os.path.join(path, state_file), encoding='utf8') as f:
+        header = json.load(f)
+    state = decode_state(header['state'])
+    ctrl.set_state(state)
+    sound.reset()
+    if header['sample'] is not None and os.path.exists(os.path.join(sound.sample_folder, header['sample'])):
+        sound.update_sample(name_or_num=header['sample'])  # by name, in case files were added to the sample folder since
+    elif sound.needs_sample():
+        sound.update_sample()
+    sound.update_synth()
+    ctrl.set_state(state)  # the new synth resets the registers and knob mode that do not fit the previous one
+    if sound.sample_ind is not None:
+        ctrl.transport_register['smp'] = sound.sample_ind
+    ctrl.transport['rec'] = False
+    ctrl.stopped = True
+    if ctrl.global_controls['osc']:  # the OSC server follows the restored flag, as after toggling it
+        ctrl.global_controls['osc'] = ctrl.start_osc()
+    else:
+        ctrl.stop_osc()
+    if header['recording']:
+        record_buffer = np.load(os.path.join(path, record_file), mmap_mode='r')
+        sound.tracks[0].record_buffer = [record_buffer]
+        sound.record_buffer_cache = record_buffer
+    ctrl.resend_states()
+    ctrl.refresh_for_display()
+    if ctrl.recorder:
+        ctrl.recorder.restore(path)
+    return path
@@ -1,13 +1,22 @@
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 from inspect import signature
 import os
 import sys
+import threading
 
-import librosa
 import numpy as np
 from pysinewave import SineWave  # note: using the customized https://github.com/eyaler/pysinewave
 
-from synths import get_note_and_chord, get_windowsize, get_slice_len, looper
+from peaks import PeakPyramid
+from pitch_index import PitchIndex
+from profiler import profiler
+import render_pool
+from render_pool import RenderPool
+from synth_pool import SynthPool
+from transport_clock import TransportClock
+from synths import dtype, get_note_and_chord, get_windowsize, get_slice_len, looper
+from voices import VoiceAllocator
 
 
 max_db = 0
@@ -17,59 +26,110 @@ interp_amp_per_sec = 200
 clip_off = False
 dither_off = False
 samplerate = 44100
+native_rate = True  # keep samples at their file rate and let the samplers step through them (False == resample to samplerate when loading)
+resample_type = 'soxr_hq'  # used when native_rate is False
 phase_cutoff = 2000000000
 mono = True
 stereo_to_mono_tolerance = 1e-3
 exit_on_error = True
+prime_frames = 512  # prebuilt sampler waveforms render one block in the background, so that slicing, pitch shifting and the first FFT windows are ready
+load_workers = None  # threads decoding the files of a folder kit (None == ThreadPoolExecutor default)
+audio_thread_init = None  # called once on each thread that renders the tracks, before its first block (engine.py raises the priority there)
+audio_extensions = ('aac', 'au', 'flac', 'm4a', 'mp3', 'ogg', 'wav')  # same as librosa.util.find_files, which we avoid importing at startup
 
 
 class Soundscape:
-    def __init__(self, ctrl, synths, default_notes, sample_folder, synth_max_bend_semitones, sampler_max_bend_semitones):
+    def __init__(self, ctrl, synths, default_notes, sample_folder, synth_max_bend_semitones, sampler_max_bend_semitones, sinewave=SineWave):
         self.ctrl = ctrl
         self.synths = synths
         self.default_notes = default_notes
         self.sample_folder = sample_folder
         self.synth_max_bend_semitones = synth_max_bend_semitones
         self.sampler_max_bend_semitones = sampler_max_bend_semitones
+        self.sinewave = sinewave
         self.notes = None
         self.chords = None
         self.drawbars = None
         self.drawbar_notes = None
         self.tracks = []
+        self.pool = SynthPool(self.build_waveforms)
+        self.render_pool = RenderPool(self.ctrl.num_tracks + 1, 1 if mono else 2, samplerate, self.ctrl.initial_knob_mode) if render_pool.processes else None
+        self.sample_version = 0  # identifies the loaded sample for caches
+        self.clock = TransportClock(self.ctrl.num_tracks + 1, samplerate)
+        self.track_info = [{} for _ in range(self.ctrl.num_tracks + 1)]  # filled by the samplers with their slice and position, for display
+        self.audio_threads = set()  # the threads that already ran audio_thread_init
         self.reset()
 
     def reset(self):
         self.sample_ind = None
+        self.sample_name = None  # the file or folder under sample_folder, for session snapshots
+        self.sample = None
+        self.pitch_index = None
+        self.peaks = None
+        self.take_peaks = {}  # id of a take -> the take and its peak pyramid, built when first displayed
+        self.sample_rate = None
+        self.sample_version += 1
+        self.elongation_key = None
+        self.elongation_disp = ''
         self.synth_ind = None
         self.kill_sound()
-        self.volumes = {k: min_db for k in range(self.ctrl.num_controls + 1)}  # +1 for live-looper play button
+        self.volumes = np.full(self.ctrl.num_tracks + 1, float(min_db))  # +1 for live-looper play button
+        self.voices = VoiceAllocator(self.ctrl.num_tracks + 1, samplerate, min_db, (max_db-min_db) / interp_amp_per_sec, self.clock)
         self.record_buffer_cache = None
         self.is_recording = False
-        self.is_track_live_looping = [False] * (self.ctrl.num_controls+1)  # +1 for live-looper play button
+        self.is_track_live_looping = [False] * (self.ctrl.num_tracks+1)  # +1 for live-looper play button
+        self.track_takes = [None] * (self.ctrl.num_tracks+1)  # the take that each live-looping track plays, which a new recording does not change
+
+    def wrap_waveform(self, k, waveform, synth_name=None):
+        synth_name = synth_name or self.synths[self.synth_ind][0]  # labels the profiler stats
+        waveform = self.clock.wrap(profiler.wrap(self.voices.wrap(waveform, k), synth_name, k, samplerate), k)
+        return self.init_audio_thread(waveform) if audio_thread_init else waveform
+
+    def init_audio_thread(self, waveform):
+        def func(x):
+            thread = threading.get_ident()
+            if thread not in self.audio_threads:
+                self.audio_threads.add(thread)
+                audio_thread_init()
+            return waveform(x)
+        return func
+
+    def set_waveform(self, k, waveform, synth_name=None):
+        self.tracks[k].set_waveform(self.wrap_waveform(k, waveform, synth_name))
 
     def kill_sound(self):
         for k in reversed(range(len(self.tracks))):
             self.tracks[k].stop()
             del self.tracks[k]
 
+    @staticmethod
+    def find_files(folder):
+        folder = os.path.abspath(folder)
+        return sorted(os.path.join(folder, f) for f in os.listdir(folder) if not f.startswith('.') and os.path.splitext(f)[1][1:].lower() in audio_extensions and os.path.isfile(os.path.join(folder, f)))
+
     @staticmethod
     def load_sample(file):
+        # returns the sample and its rate, which is the file rate with native_rate
+        import librosa  # imported on first decode, as it is slow to import
         assert isinstance(file, str)
         try:
-            sample = librosa.load(file, sr=samplerate, mono=mono)[0]
+            sample, rate = librosa.load(file, sr=None if native_rate else samplerate, mono=mono, res_type=resample_type)
         except Exception as e:
             print(e)
             print('Error loading sample', file)
             if exit_on_error:
                 sys.exit(1)
-            return None
+            return None, None
+        # the channel layout is decided here once, and the synths keep it: mono samples are 1-D and stereo samples are (2, frames)
         if stereo_to_mono_tolerance is not None and len(sample.shape) == 2 and np.allclose(sample[0], sample[1], rtol=0,
                                                                                            atol=stereo_to_mono_tolerance):
             sample = librosa.to_mono(sample)
+        sample = np.ascontiguousarray(sample, dtype=dtype)
         scale = abs(sample).max()
         if scale > 1:
             sample /= scale
-        return sample
+        sample.flags.writeable = False  # shared by all the tracks and synths using it
+        return sample, rate
 
     @staticmethod
     def hasattr_partial(f, attr):
@@ -88,24 +148,33 @@ class Soundscape:
         return default
 
     def get_set_elongation(self, no_roll=False):
+        key = (self.synth_ind, self.ctrl.track_register['smp'], no_roll, self.sample_version)
+        if key != self.elongation_key:
+            self.elongation_disp = self.compute_set_elongation(no_roll=no_roll)
+            self.elongation_key = (self.synth_ind, self.ctrl.track_register['smp'], no_roll, self.sample_version)
+        return self.elongation_disp
+
+    def compute_set_elongation(self, no_roll=False):
         func = self.synths[self.synth_ind][1]
-        if not hasattr(func, 'keywords'):
+        if not hasattr(func, 'keywords') or self.sample is None:
             return ''
         sample = self.sample
+        sample_rate = self.sample_rate
         smart_skipping = True
         slice_secs = self.get_default(func, 'slice_secs')
         if isinstance(sample, list):
             lengths = [s.shape[-1] for s in sample]
             sample = sample[lengths.index(max(lengths))]
+            sample_rate = sample_rate[lengths.index(max(lengths))]
             smart_skipping = all(length == self.sample[0].shape[-1] for length in lengths[1:])
             slice_secs = None
         windowsize_secs = self.get_default(func, 'windowsize_secs')
-        windowsize = None if not windowsize_secs else get_windowsize(windowsize_secs, samplerate)
+        windowsize = None if not windowsize_secs else get_windowsize(windowsize_secs, sample_rate)
         advance_factor = self.get_default(func, 'advance_factor')
         loop_mode = self.get_default(func, 'loop_mode')
         elongate_steps = self.ctrl.track_register['smp']
         elongate_factor = self.get_default(func, 'elongate_factor')
-        slice_len, new_elongate_steps = get_slice_len(sample, slice_secs, samplerate, windowsize=windowsize,
+        slice_len, new_elongate_steps = get_slice_len(sample, slice_secs, sample_rate, windowsize=windowsize,
                                                       advance_factor=advance_factor, loop_mode=loop_mode,
                                                       elongate_steps=elongate_steps, elongate_factor=elongate_factor,
                                                       smart_skipping=smart_skipping, no_roll=no_roll,
@@ -114,14 +183,15 @@ class Soundscape:
             self.ctrl.track_register['smp'] = new_elongate_steps
         slice_str = '\nslice='
         if smart_skipping or windowsize_secs and not advance_factor:
-            slice_str += str(round(slice_len / samplerate * 1000)) + 'ms'
+            slice_str += str(round(slice_len / sample_rate * 1000)) + 'ms'
         else:
             slice_str += str(round(slice_len / sample.shape[-1] * 100)) + '%'
         return slice_str
 
     @property
     def synth_disp(self):
-        return f'{self.synth_ind + 1}.' + self.synths[self.synth_ind][0]
+        bank_str = f' [bank {self.ctrl.bank + 1}/{self.ctrl.num_banks}]' if self.ctrl.num_banks > 1 else ''
+        return f'{self.synth_ind + 1}.' + self.synths[self.synth_ind][0] + bank_str
 
     @property
     def sample_disp(self):
@@ -147,7 +217,7 @@ class Soundscape:
     @property
     def record_buffer(self):
         if self.record_buffer_cache is None:
-            buffers = [np.hstack(self.tracks[k].record_buffer) for k in range(self.ctrl.num_controls) if
+            buffers = [np.hstack(self.tracks[k].record_buffer) for k in range(self.ctrl.num_tracks) if
                        self.tracks[k].record_buffer]
             lengths_set = {buffer.shape[-1] for buffer in buffers}
             if len(lengths_set) > 1:
@@ -156,31 +226,38 @@ class Soundscape:
             channels_set = {len(buffer.shape) for buffer in buffers}
             if len(channels_set) > 1:
                 buffers = [np.tile(buffer, reps=(2, 1)) if len(buffer.shape) == 1 else buffer for buffer in buffers]
-            self.record_buffer_cache = np.sum(buffers, axis=0)
+            # one immutable take, which all the loopers share: they slice views of it, and their transforms make new arrays
+            # a new recording replaces the cache, and the old take is freed with the last looper that reads it
+            take = np.asarray(np.sum(buffers, axis=0)).astype(dtype)
+            take.flags.writeable = False
+            self.record_buffer_cache = take
         return self.record_buffer_cache
 
     def update_record(self):
         if 'rec' in self.ctrl.transport:
             if self.ctrl.transport['rec'] != self.is_recording:
-                for k in range(self.ctrl.num_controls):
+                for k in range(self.ctrl.num_tracks):
                     self.tracks[k].record(start=not self.is_recording, clear=self.ctrl.stopped and not self.is_recording)
                 self.is_recording = self.ctrl.transport['rec']
                 if self.is_recording:
                     self.ctrl.stopped = False
 
         if self.ctrl.transport.get('play'):
-            if not self.is_track_live_looping[self.ctrl.num_controls]:
+            if not self.is_track_live_looping[self.ctrl.num_tracks]:
                 if self.record_buffer.shape[-1]:
-                    self.is_track_live_looping[self.ctrl.num_controls] = True
-                    waveform = looper(ctrl=self.ctrl, sample=np.copy(self.record_buffer), samplerate=samplerate)
-                    self.tracks[self.ctrl.num_controls].set_waveform(waveform)
+                    self.is_track_live_looping[self.ctrl.num_tracks] = True
+                    self.track_takes[self.ctrl.num_tracks] = self.record_buffer
+                    waveform = looper(ctrl=self.ctrl, sample=self.track_takes[self.ctrl.num_tracks], samplerate=samplerate,
+                                      clock=self.clock.voices[self.ctrl.num_tracks])
+                    self.set_waveform(self.ctrl.num_tracks, waveform, 'looper')
                 else:
                     self.ctrl.new_transport['play'] = False
         else:
-            self.is_track_live_looping[self.ctrl.num_controls] = False
+            self.is_track_live_looping[self.ctrl.num_tracks] = False
+            self.track_takes[self.ctrl.num_tracks] = None
 
         if 'r' in self.ctrl.states:
-            for k, should_live_loop in self.ctrl.states['r'].items():
+            for k, should_live_loop in enumerate(self.ctrl.states['r'].tolist()):
                 if should_live_loop != self.is_track_live_looping[k]:
                     if should_live_loop:
                         if not self.record_buffer.shape[-1]:
@@ -188,34 +265,52 @@ class Soundscape:
                             continue
                         self.is_track_live_looping[k] = True
                         waveform = partial(looper, notes=self.notes, max_bend_semitones=self.sampler_max_bend_semitones)
-                        sample = np.copy(self.record_buffer)
+                        sample = self.track_takes[k] = self.record_buffer
+                        sample_rate = samplerate
+                        pitch_index = None
                     else:
                         self.is_track_live_looping[k] = False
+                        self.track_takes[k] = None
                         waveform = self.synths[self.synth_ind][1]
                         sample = self.sample
+                        sample_rate = self.sample_rate
+                        pitch_index = self.pitch_index
                     if self.hasattr_partial(waveform, 'is_func_factory'):
-                        waveform = waveform(track=k, ctrl=self.ctrl, sample=sample, samplerate=samplerate)
-                    self.tracks[k].set_waveform(waveform)
+                        waveform = waveform(track=k, ctrl=self.ctrl, sample=sample, samplerate=samplerate, sample_rate=sample_rate,
+                                            pitch_index=pitch_index, clock=self.clock.voices[k], track_info=self.track_info[k])
+                    self.set_waveform(k, waveform, 'looper' if should_live_loop else None)
                     if not self.synths[self.synth_ind][0].lower().startswith('smp'):
                         self.ctrl.toggle_knob_mode(is_sampler=self.is_track_live_looping[k], track=k)
 
         if self.is_recording:
             self.record_buffer_cache = None
 
+    def track_peaks(self, k):
+        # the peak pyramid of what track k plays, or None if it is not sampling
+        if self.is_track_live_looping[k]:
+            take = self.track_takes[k]
+            if id(take) not in self.take_peaks:
+                self.take_peaks = {key: value for key, value in self.take_peaks.items() if any(value[0] is t for t in self.track_takes)}
+                self.take_peaks[id(take)] = take, PeakPyramid(take)
+            return self.take_peaks[id(take)][1]
+        if self.peaks is None or not self.synths[self.synth_ind][0].lower().startswith('smp'):
+            return None
+        return self.peaks[k] if isinstance(self.peaks, list) else self.peaks
+
     def update_sample(self, name_or_num=None):
         ind = self.ctrl.transport_register['smp']
         if self.sample_ind == ind and name_or_num is None:
             return
-        files = librosa.util.find_files(self.sample_folder, recurse=False)
+        files = self.find_files(self.sample_folder)
         folders = [os.path.join(self.sample_folder, f) for f in os.listdir(self.sample_folder)]
-        folders = [f for f in folders if os.path.isdir(f) and librosa.util.find_files(f, recurse=False)]
+        folders = [f for f in folders if os.path.isdir(f) and self.find_files(f)]
         paths = sorted(files + folders)
         if name_or_num is not None:
             try:
                 inds = [int(name_or_num) - 1]
             except ValueError:
                 name_or_num = str(name_or_num)
-                inds = [i for i, path in enumerate(paths) if path.rstrip(os.sep) == os.path.join(self.sample_folder, name_or_num).rstrip(os.sep)]
+                inds = [i for i, path in enumerate(paths) if os.path.relpath(path, self.sample_folder) == os.path.normpath(name_or_num)]  # files are absolute and folders relative
             if not inds:
                 print('Missing sample', name_or_num)
                 if exit_on_error:
@@ -225,21 +320,31 @@ class Soundscape:
         direction = 1 if self.sample_ind is None or ind >= self.sample_ind else -1
         ind %= len(paths)
         path = paths[ind]
+        name = os.path.relpath(path, self.sample_folder)
         if os.path.isdir(path):
-            sample_paths = librosa.util.find_files(path, recurse=False)
-            sample = []
-            k = 0
-            while len(sample) < self.ctrl.num_controls and k < len(sample_paths) * self.ctrl.num_controls:
-                track_sample = self.load_sample(sample_paths[k % len(sample_paths)])
-                if track_sample is not None:
-                    sample.append(track_sample)
-                k += 1
+            sample_paths = self.find_files(path)
+            # each file is decoded once, in parallel, and the tracks cycle over the files that loaded
+            loaded = []
+            with ThreadPoolExecutor(max_workers=load_workers, thread_name_prefix='load_sample') as executor:
+                done = 0
+                while len(loaded) < self.ctrl.num_tracks and done < len(sample_paths):
+                    batch = sample_paths[done : done + self.ctrl.num_tracks - len(loaded)]
+                    loaded += [(file, track_sample, rate) for file, (track_sample, rate) in zip(batch, executor.map(self.load_sample, batch)) if track_sample is not None]
+                    done += len(batch)
+            pitch_indexes = [PitchIndex(track_sample, rate, path=file) for file, track_sample, rate in loaded]
+            pyramids = [PeakPyramid(track_sample, path=file) for file, track_sample, rate in loaded]
+            sample = [loaded[k % len(loaded)][1] for k in range(self.ctrl.num_tracks)] if loaded else None
+            sample_rate = [loaded[k % len(loaded)][2] for k in range(self.ctrl.num_tracks)] if loaded else None
+            pitch_index = [pitch_indexes[k % len(loaded)] for k in range(self.ctrl.num_tracks)] if loaded else None
+            peaks = [pyramids[k % len(loaded)] for k in range(self.ctrl.num_tracks)] if loaded else None
             if len(sample_paths) == 1:
                 path = sample_paths[0]
             else:
-                path = path.rstrip(os.sep) + os.sep + f'[{min(len(sample_paths), self.ctrl.num_controls)} files]'
+                path = path.rstrip(os.sep) + os.sep + f'[{min(len(sample_paths), self.ctrl.num_tracks)} files]'
         else:
-            sample = self.load_sample(path)
+            sample, sample_rate = self.load_sample(path)
+            pitch_index = None if sample is None else PitchIndex(sample, sample_rate, path=path)
+            peaks = None if sample is None else PeakPyramid(sample, path=path)
         if sample is None:
             if name_or_num is not None:
                 return
@@ -247,8 +352,15 @@ class Soundscape:
             return self.update_sample()
         self.ctrl.transport_register['smp'] = ind
         self.sample_ind = ind
+        self.sample_name = name
         self.sample_path = path
         self.sample = sample
+        self.sample_rate = sample_rate
+        self.pitch_index = pitch_index
+        self.peaks = peaks
+        for info in self.track_info:
+            info.clear()
+        self.sample_version += 1
         self.synth_ind = None
 
     def update_synth(self, name_or_num=None):
@@ -284,42 +396,77 @@ class Soundscape:
             self.ctrl.transport_register['syn'] = 0
             self.drawbars = new_drawbars
             self.drawbar_notes = new_drawbar_notes
-        for k in range(self.ctrl.num_controls + 1):  # +1 for live-looper play button
-            waveform = synth[1]
-            safe_track = k % self.ctrl.num_controls
-            if self.hasattr_partial(waveform, 'is_func_factory'):
-                waveform = waveform(track=safe_track, ctrl=self.ctrl, sample=self.sample, samplerate=samplerate)
+        self.pool.invalidate(self.sample_version)
+        if self.renders_in_pool(synth_ind):
+            waveforms = self.render_pool.assign(synth[1], self.sample, self.sample_version,
+                                                {k: k % self.ctrl.num_tracks for k in range(self.ctrl.num_tracks + 1)},
+                                                frames=self.clock.frames.tolist(), sample_rate=self.sample_rate, pitch_index=self.pitch_index)
+        else:
+            if self.render_pool:
+                self.render_pool.stop()
+            waveforms = self.pool.take(synth_ind)
+        self.pool.prefetch(synth_ind, len(self.synths))
+        for k, waveform in enumerate(waveforms):
+            safe_track = k % self.ctrl.num_tracks
             if len(self.tracks) == k:
-                self.tracks.append(SineWave(pitch=get_note_and_chord(self.ctrl, safe_track, self.notes, fix_bins=True),
+                self.tracks.append(self.sinewave(pitch=get_note_and_chord(self.ctrl, safe_track, self.notes, fix_bins=True),
                                             pitch_per_second=interp_hz_per_sec, decibels=min_db,
                                             decibels_per_second=interp_amp_per_sec, channels=1 if mono else 2,
                                             samplerate=samplerate, clip_off=False, dither_off=False,
-                                            waveform=waveform, phase_cutoff=phase_cutoff, db_cutoff=min_db))
+                                            waveform=self.wrap_waveform(k, waveform), phase_cutoff=phase_cutoff, db_cutoff=min_db))
                 self.tracks[k].play()
-            elif k < self.ctrl.num_controls and ('r' not in self.ctrl.states or not self.ctrl.states['r'][k]):
-                self.tracks[k].set_waveform(waveform)
+            elif k < self.ctrl.num_tracks and ('r' not in self.ctrl.states or not self.ctrl.states['r'][k]):
+                self.set_waveform(k, waveform)
+
+    def build_waveforms(self, synth_ind):
+        synth = self.synths[synth_ind]
+        is_sampler = synth[0].lower().startswith('smp')
+        if is_sampler and self.sample is None or self.renders_in_pool(synth_ind):
+            return None
+        waveforms = []
+        for k in range(self.ctrl.num_tracks + 1):  # +1 for live-looper play button
+            waveform = synth[1]
+            if self.hasattr_partial(waveform, 'is_func_factory'):
+                waveform = waveform(track=k % self.ctrl.num_tracks, ctrl=self.ctrl, sample=self.sample, samplerate=samplerate,
+                                    sample_rate=self.sample_rate, pitch_index=self.pitch_index, clock=self.clock.voices[k],
+                                    track_info=self.track_info[k])
+                if is_sampler:
+                    waveform(np.zeros(prime_frames))
+            waveforms.append(waveform)
+        return waveforms
+
+    def renders_in_pool(self, synth_ind):
+        # workers render ahead of the audio callbacks, so only synths that ignore the phase input can run there
+        return self.render_pool is not None and self.hasattr_partial(self.synths[synth_ind][1], 'skip_external_pitch_control')
 
     def update_volume_pitch(self):
-        for k in range(len(self.volumes)):
-            volume = min_db
-            if not self.ctrl.is_effective_mute(k):
-                if k < self.ctrl.num_controls:
-                    volume += self.ctrl.controls[k + self.ctrl.slider_cc] / 127 * (max_db-min_db)
-                elif self.is_track_live_looping[k]:
-                    volume = max_db
-            if volume != self.volumes[k]:
-                self.tracks[k].set_volume(volume)
-                self.volumes[k] = volume
+        volumes = np.full(len(self.volumes), float(min_db))
+        volumes[:self.ctrl.num_tracks] += np.where(self.ctrl.effective_mutes(), 0, self.ctrl.controls[self.ctrl.slider_ccs] / 127 * (max_db-min_db))
+        if self.is_track_live_looping[self.ctrl.num_tracks] and not self.ctrl.is_effective_mute(self.ctrl.num_tracks):
+            volumes[self.ctrl.num_tracks] = max_db
+        for k in np.flatnonzero(volumes != self.volumes).tolist():
+            self.tracks[k].set_volume(volumes[k])
+            self.voices.set_volume(k, volumes[k])
+        self.volumes = volumes
+        for k in self.voices.steal():
+            self.tracks[k].set_volume(min_db)
 
         if not self.hasattr_partial(self.synths[self.synth_ind][1], 'skip_external_pitch_control'):
             for cc, v in self.ctrl.new_controls.items():
-                k = cc - self.ctrl.knob_cc
-                if 0 <= k < self.ctrl.num_controls:
+                k = self.ctrl.cc_track(cc, self.ctrl.knob_cc)
+                if k is not None:
                     self.tracks[k].set_pitch(
                         get_note_and_chord(self.ctrl, k, self.notes, fix_bins=True) + self.ctrl.norm_knob(v)*self.synth_max_bend_semitones)
 
+    def needs_sample(self):
+        # samples are only decoded once a sampler is selected
+        return self.sample is not None or self.synths[self.ctrl.marker_register % len(self.synths)][0].lower().startswith('smp')
+
     def update(self):
+        if self.render_pool:
+            self.render_pool.sync(self.ctrl)
         self.update_record()
-        self.update_sample()
+        if self.needs_sample():
+            self.update_sample()
         self.update_synth()
         self.update_volume_pitch()
@@ -0,0 +1,36 @@
+from concurrent.futures import ThreadPoolExecutor
+
+
+neighbors = 1  # prebuild this many synths before and after the current one, besides a fresh copy of the current one
+background = True  # False builds on demand only, e.g. for deterministic replays
+
+
+class SynthPool:
+    # builds the per-track waveforms of synths in a background thread, so that switching synths only swaps them in
+    def __init__(self, build):
+        self.build = build  # build(synth_ind) returns the list of waveforms for all tracks
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='synth_pool')
+        self.futures = {}
+        self.key = None
+
+    def invalidate(self, key):
+        # key identifies what the builds depend on besides the live controller state, i.e. the loaded sample
+        if key != self.key:
+            for future in self.futures.values():
+                future.cancel()
+            self.futures = {}
+            self.key = key
+
+    def take(self, synth_ind):
+        future = self.futures.pop(synth_ind, None)
+        if future is not None and not future.cancel():  # already running or done, so waiting is faster than building again
+            return future.result()
+        return self.build(synth_ind)
+
+    def prefetch(self, synth_ind, num_synths):
+        if not background:
+            return
+        for offset in range(-neighbors, neighbors + 1):
+            ind = (synth_ind+offset) % num_synths
+            if ind not in self.futures:
+                self.futures[ind] = self.executor.submit(self.build, ind)
@@ -1,14 +1,21 @@
+from functools import partial, wraps
+import threading
 from time import time
 from types import SimpleNamespace
 
-import librosa
-from numba import jit
 import numpy as np
-import pyrubberband
 from pysinewave.utilities import MIDDLE_C_FREQUENCY
 
+from phase_tables import get_table
+from profiler import profiler
+from texture_cache import TextureCache
 
-rng = np.random  # .Generator(np.random.MT19937())  # Mersenne Twister
+
+random_seed = None  # set an int for reproducible paulstretch renders (track k draws its phases from a generator seeded with random_seed + k)
+
+dtype = np.float32  # processing dtype of synth outputs, samples, buffers and FFTs (complex64 spectra for float32)
+complex_dtype = np.result_type(dtype, np.complex64)
+# phases (the x passed to waveforms) stay float64, as float32 cannot resolve the phase at large values (see soundscape.phase_cutoff)
 
 gain_normalization_exponent = 1
 # controls the tradeoff between clipping artifacts and volume limiting when having multiple harmonics (chords, drawbars) per synth track
@@ -18,6 +25,13 @@ gain_normalization_exponent = 1
 
 bins_per_octave = 12
 
+loop_sync = True  # loopers take their position from the transport clock since their last restart, so that tracks restarted together stay in phase
+
+stretch_lookahead_windows = 0  # extra paulstretch windows rendered per batch, each adding windowsize/2 of control latency
+stretch_gain = 1.6**2 / 2**0.5  # my estimated amplitude correction of the overlap-add
+freeze_texture_secs = 4  # length of the looped textures that paulstretch pre-renders for frozen spectra (0 == always synthesize live)
+freeze_crossfade_secs = 0.25  # the end of each texture is crossfaded into its start, so that it loops seamlessly
+
 hammond_drawbar_notes = (-12, 7, 0, 12, 19, 24, 28, 31, 36)
 
 C = SimpleNamespace(M=[0, 4, 7, 11], m=[0, 3, 7, 10], D=[0, 4, 7, 10], o=[0, 3, 6, 9], A=[0, 4, 8, 10])  # usually seventh=False and the 4th note is ignored; M must come before D
@@ -72,7 +86,13 @@ def get_note_and_chord(ctrl, k, notes, chords=None, fix_bins=False):
     if k is None:
         return None
     scale_quality = ctrl.track_register['syn'] % len(notes)
-    note = notes[scale_quality][k] + ctrl.track_register['syn']//len(notes)
+    scale = notes[scale_quality]
+    if k < len(scale):
+        note = scale[k]
+    else:  # tracks beyond the scale (more than one bank) continue in the next octaves, as the last note of a scale is the octave of its first
+        octave, k_in_scale = divmod(k, len(scale) - 1)
+        note = scale[k_in_scale] + octave*bins_per_octave
+    note += ctrl.track_register['syn']//len(notes)
     if fix_bins:
         note *= 12 / bins_per_octave
     if chords:
@@ -95,7 +115,7 @@ def dsaw(detune_semitones=0):
         output = sawtooth(x * 2**(-detune_semitones/2/bins_per_octave))
         if detune_semitones:
             output = (output+sawtooth(x * 2**(detune_semitones/2/bins_per_octave))) / 2**gain_normalization_exponent
-        return output
+        return output.astype(dtype, copy=False)
     return func
 
 
@@ -107,9 +127,70 @@ def harmonizer(waveform, x, drawbar, drawbar_notes=hammond_drawbar_notes):
     return np.sum([v * waveform(x * 2**(n/bins_per_octave)) for v, n in zip(drawbar, drawbar_notes) if v], axis=0) / sum(drawbar)**gain_normalization_exponent
 
 
-@jit(cache=True)
+def compile_partials(chord, drawbar, drawbar_notes=hammond_drawbar_notes):
+    # flattens the chord tones times the drawbar notes into unique partials, summing the amplitudes of those that coincide
+    # returns the frequency ratios and amplitudes, so that the sum over them equals the harmonizer sum over the chord tones
+    levels = [(0, 1)]
+    if drawbar is not None:
+        if isinstance(drawbar, str):
+            drawbar = [int(c) for c in drawbar]
+        levels = [(n, v / sum(drawbar)**gain_normalization_exponent) for v, n in zip(drawbar, drawbar_notes) if v]
+    partials = {}
+    for note in chord:
+        for n, level in levels:
+            partials[note + n] = partials.get(note + n, 0) + level
+    return 2**(np.array(list(partials)) / bins_per_octave), np.array(list(partials.values()))
+
+
+textures = TextureCache()  # pre-rendered paulstretch freeze textures
+
+
+jit_kernels = []  # all lazy_jit kernels, compiled ahead of the first note by warmup_kernels()
+kernels_warm = threading.Event()
+
+
+def lazy_jit(warmup_args=(), **jit_kwargs):
+    # defers importing numba and compiling to the first call, which keeps startup fast
+    # warmup_args lists example argument tuples covering every dtype and dimensionality the kernel is called with
+    def decorator(py_func):
+        compiled = None
+        lock = threading.Lock()
+
+        def compile_kernel():
+            nonlocal compiled
+            with lock:
+                if compiled is None:
+                    from numba import jit
+                    compiled = jit(**jit_kwargs)(py_func)
+            return compiled
+
+        @wraps(py_func)
+        def func(*args):
+            return (compiled or compile_kernel())(*args)
+
+        func.compile = compile_kernel
+        func.warmup_args = warmup_args
+        jit_kernels.append(func)
+        return func
+    return decorator
+
+
+def warmup_kernels():
+    # compiles (or loads from numba's cache) every registered kernel for every signature we use, meant to run in a background thread at startup
+    # and then imports librosa, which the audio callbacks would otherwise import on first use
+    for kernel in jit_kernels:
+        compiled = kernel.compile()
+        for args in kernel.warmup_args:
+            compiled(*args)
+    kernels_warm.set()
+    import librosa  # used by trim_to_zero loops
+
+
+@lazy_jit(warmup_args=[(np.zeros(1), 1, 0.0, 44100, 1.0, np.zeros(1, dtype=dtype), 1.0)], cache=True)
 def get_arpeggio_frames(x, lcn, t, samplerate, arpeggio_secs, save_steps, arpeggio_amp_step):
-    frames = np.empty((lcn, *x.shape))
+    # note: argument types must match warmup_args, otherwise numba compiles a new signature inside the audio callback
+    # x is the float64 phase array, and the frames follow the dtype of save_steps
+    frames = np.empty((lcn, *x.shape), save_steps.dtype)
     for j in range(len(x)):
         ind = int((t+j/samplerate) / arpeggio_secs % lcn)
         for i in range(lcn):
@@ -121,31 +202,39 @@ def get_arpeggio_frames(x, lcn, t, samplerate, arpeggio_secs, save_steps, arpegg
 def chord_arp(waveform=np.sin, chords=(0,), seventh=False, drawbars=None, drawbar_notes=hammond_drawbar_notes, arpeggio_order=1, arpeggio_secs=None, arpeggio_amp_step=1, samplerate=44100, **kwargs):
     track = kwargs['track']
     ctrl = kwargs['ctrl']
+    clock = kwargs.get('clock')  # the arpeggio steps follow the rendered audio, falling back to the wall clock
     chords, drawbars = fix_chords(chords, drawbars)
     chords = [trim_chord(chord_for_quality[track % len(chord_for_quality)], seventh=seventh)[::arpeggio_order] for chord_for_quality in chords]
-    save_steps = []
+    save_steps = np.zeros(0, dtype=dtype)
     prev_lcn = 0
+    partials_key = None  # the chord and drawbar that ratios and amplitudes were compiled for
+    ratios = amplitudes = None
 
     def func(x):
-        nonlocal save_steps, prev_lcn
+        nonlocal save_steps, prev_lcn, partials_key, ratios, amplitudes
         chord_for_quality = chords[ctrl.track_register['syn'] % len(chords)]
         lcn = len(chord_for_quality)
-        if save_steps is None or prev_lcn != lcn:
+        if prev_lcn != lcn:
             if lcn > prev_lcn:
-                save_steps += [0] * (lcn-prev_lcn)
+                save_steps = np.concatenate((save_steps, np.zeros(lcn - prev_lcn, dtype=dtype)))
             else:
-                del save_steps[lcn:]
+                save_steps = save_steps[:lcn]
             prev_lcn = lcn
         if arpeggio_secs:  # note: requires high CPU settings otherwise you get clicks
-            frames = get_arpeggio_frames(x, lcn, time(), samplerate, arpeggio_secs, save_steps, arpeggio_amp_step)
+            frames = get_arpeggio_frames(x, lcn, time() if clock is None else clock.secs, int(samplerate), float(arpeggio_secs), save_steps, float(arpeggio_amp_step))
             for i in range(lcn):
                 save_steps[i] = frames[i][-1]
+            output = np.sum([frames[i] * harmonizer(waveform, x * 2**(n/bins_per_octave), drawbars[ctrl.transport_register['syn'] % len(drawbars)], drawbar_notes=drawbar_notes) for i, n in enumerate(chord_for_quality) if np.any(frames[i])], axis=0)
         else:
-            frames = [1] * lcn
-        output = np.sum([frames[i] * harmonizer(waveform, x * 2**(n/bins_per_octave), drawbars[ctrl.transport_register['syn'] % len(drawbars)], drawbar_notes=drawbar_notes) for i, n in enumerate(chord_for_quality) if np.any(frames[i])], axis=0)
+            key = (ctrl.track_register['syn'] % len(chords), ctrl.transport_register['syn'] % len(drawbars))
+            if key != partials_key:
+                partials_key = key
+                ratios, amplitudes = compile_partials(chord_for_quality, drawbars[key[1]], drawbar_notes=drawbar_notes)
+            output = amplitudes @ waveform(ratios[:, None] * x)
         if output.shape != x.shape:
-            output = np.zeros_like(x)
-        elif not arpeggio_secs:
+            return np.zeros(x.shape, dtype=dtype)
+        output = output.astype(dtype, copy=False)
+        if not arpeggio_secs:
             output /= lcn ** gain_normalization_exponent
         return output
     return func
@@ -227,7 +316,7 @@ def get_slice_len(sample, slice_secs, samplerate, windowsize=None, advance_facto
     return slice_len
 
 
-def slice_scrub_bend(elongate_steps, ctrl, slice_len, sample, slice_secs, samplerate, elongate_factor, loop_mode, stable_last_slice_start, max_scrub_secs, pos, scrub_knob, track, loop_smp, pitch_knob, shifted, notes, note, freqs=None, windowsize=None, advance_factor=0, smart_skipping=False):
+def slice_scrub_bend(elongate_steps, ctrl, slice_len, sample, slice_secs, samplerate, elongate_factor, loop_mode, stable_last_slice_start, max_scrub_secs, pos, scrub_knob, track, loop_smp, pitch_knob, shifted, notes, note, freqs=None, windowsize=None, advance_factor=0, smart_skipping=False, loop_start=None):
     if elongate_steps != ctrl.track_register['smp']:
         elongate_steps = ctrl.track_register['smp']
         slice_len = get_slice_len(sample, slice_secs, samplerate, windowsize=windowsize, advance_factor=advance_factor, loop_mode=loop_mode, elongate_steps=elongate_steps, elongate_factor=elongate_factor, smart_skipping=smart_skipping)
@@ -249,14 +338,14 @@ def slice_scrub_bend(elongate_steps, ctrl, slice_len, sample, slice_secs, sample
             scrub_len = min(scrub_len, round(max_scrub_secs * samplerate))
         global_pos = max(0, min(int(scrub_knob*scrub_len + ctrl.relative_track(track)*stable_last_slice_start), max_global_pos))
         loop_smp = sample[..., global_pos : global_pos + abs(slice_len)]
+        loop_start = global_pos
         if slice_len < 0:
             loop_smp = loop_smp[..., ::-1]
         if loop_mode == 'trim_to_zero':
-            if len(loop_smp.shape) > 1:
-                loop_smp = librosa.to_mono(loop_smp)
-            zeros = np.nonzero(librosa.zero_crossings(loop_smp))[0]
+            import librosa
+            zeros = np.nonzero(librosa.zero_crossings(loop_smp if loop_smp.ndim == 1 else loop_smp.mean(axis=0)))[0]
             if len(zeros) > 1:
-                loop_smp = loop_smp[zeros[0]:zeros[-1]]
+                loop_smp = loop_smp[..., zeros[0]:zeros[-1]]
         elif loop_mode == 'reverse' and (not windowsize or advance_factor):
             loop_smp = np.hstack((loop_smp, loop_smp[..., ::-1]))
         freqs = None
@@ -275,20 +364,41 @@ def slice_scrub_bend(elongate_steps, ctrl, slice_len, sample, slice_secs, sample
         if note is not None:
             shifted = None
         note = None
-    return elongate_steps, slice_len, stable_last_slice_start, pos, scrub_knob, loop_smp, pitch_knob, shifted, note, windowsize, freqs
+    return elongate_steps, slice_len, stable_last_slice_start, pos, scrub_knob, loop_smp, pitch_knob, shifted, note, windowsize, freqs, loop_start
+
 
+def loop_to_sample(p, loop_start, slice_len):
+    # maps a position in the loop (which may be reversed, or followed by its reverse) to a position in the sample
+    length = abs(slice_len)
+    p %= 2 * length
+    if p >= length:
+        p = 2*length - p
+    return loop_start + (p if slice_len > 0 else length - p)
 
-def looper(notes=None, max_bend_semitones=bins_per_octave, slice_secs=None, elongate_factor=0.05, max_scrub_secs=None, loop_mode='trim_to_zero', samplerate=44100, mono=True, **kwargs):
-    # we currently use pysinewave which is (possibly duplicated) mono, so have to convert result to mono
+
+def source_note(pitch_index, start, end):
+    # the f0 of the sample between positions start and end in bins relative to middle C, or None if unvoiced or not analysed yet
+    f0 = pitch_index.f0_at(min(start, end), max(start, end)) if pitch_index is not None else None
+    return None if f0 is None else bins_per_octave * np.log2(f0 / MIDDLE_C_FREQUENCY)
+
+
+def looper(notes=None, max_bend_semitones=bins_per_octave, slice_secs=None, elongate_factor=0.05, max_scrub_secs=None, loop_mode='trim_to_zero', samplerate=44100, **kwargs):
+    # the output has the channel layout of the sample, which is decided when loading it
     track = kwargs.get('track')
     ctrl = kwargs['ctrl']
     sample = kwargs['sample']
+    sample_rate = kwargs.get('sample_rate') or samplerate  # the sample keeps its native rate, and playback steps through it at sample_rate / samplerate
+    pitch_index = kwargs.get('pitch_index')  # used for autotune with set
+    clock = kwargs.get('clock') if loop_sync else None
+    track_info = kwargs.get('track_info')  # gets the slice and the position in the sample, for display
     smart_skipping = True
     if isinstance(sample, list):
         smart_skipping = all(s.shape[-1] == sample[0].shape[-1] for s in sample[1:])
         sample = sample[track]
+        sample_rate = sample_rate[track] if isinstance(sample_rate, list) else sample_rate
+        pitch_index = pitch_index and pitch_index[track]
         slice_secs = None
-    channels = len(sample.shape)
+    step = sample_rate / samplerate
 
     elongate_steps = None
     slice_len = None
@@ -299,17 +409,44 @@ def looper(notes=None, max_bend_semitones=bins_per_octave, slice_secs=None, elon
     pitch_knob = None
     shifted = None
     note = None
+    loop_start = None
+    index_ready = False
+    restart_frame = 0  # the clock frame at which the loop last restarted from its start
 
     def func(x):
-        nonlocal elongate_steps, slice_len, stable_last_slice_start, pos, scrub_knob, loop_smp, pitch_knob, shifted, note
-        elongate_steps, slice_len, stable_last_slice_start, pos, scrub_knob, loop_smp, pitch_knob, shifted, note, *_ = slice_scrub_bend(elongate_steps, ctrl, slice_len, sample, slice_secs, samplerate, elongate_factor, loop_mode, stable_last_slice_start, max_scrub_secs, pos, scrub_knob, track, loop_smp, pitch_knob, shifted, notes, note, smart_skipping=smart_skipping)
+        nonlocal elongate_steps, slice_len, stable_last_slice_start, pos, scrub_knob, loop_smp, pitch_knob, shifted, note, loop_start, index_ready, restart_frame
+        if clock is not None:
+            pos = None  # slice_scrub_bend sets it to 0 when the loop restarts
+        elongate_steps, slice_len, stable_last_slice_start, pos, scrub_knob, loop_smp, pitch_knob, shifted, note, _, _, loop_start = slice_scrub_bend(elongate_steps, ctrl, slice_len, sample, slice_secs, sample_rate, elongate_factor, loop_mode, stable_last_slice_start, max_scrub_secs, pos, scrub_knob, track, loop_smp, pitch_knob, shifted, notes, note, smart_skipping=smart_skipping, loop_start=loop_start)
+        if note is not None and pitch_index is not None and pitch_index.ready != index_ready:
+            index_ready = pitch_index.ready
+            shifted = None
         if shifted is None:
             shifted = loop_smp
-            if pitch_knob:
-                shifted = pyrubberband.pitch_shift(loop_smp.T, samplerate, pitch_knob * max_bend_semitones * 12 / bins_per_octave, rbargs={'--realtime': '--realtime'}).T
-            if mono and channels > 1:
-                shifted = librosa.to_mono(shifted)
-
+            semitones = pitch_knob * max_bend_semitones
+            source = None if note is None else source_note(pitch_index, loop_start, loop_to_sample(abs(slice_len), loop_start, slice_len))
+            if source is not None:
+                semitones += note - source
+            semitones *= 12 / bins_per_octave
+            if semitones:
+                import pyrubberband
+                with profiler.section('rubberband', track):
+                    shifted = pyrubberband.pitch_shift(loop_smp.T, sample_rate, semitones, rbargs={'--realtime': '--realtime'}).T.astype(dtype)
+
+        if clock is not None:
+            if pos == 0:
+                restart_frame = clock.frames
+            pos = (clock.frames - restart_frame) * step % shifted.shape[-1]
+        if track_info is not None:
+            track_info.update(start=loop_start, length=slice_len, pos=loop_to_sample(int(pos), loop_start, slice_len))
+        if step != 1:
+            # fractional steps through samples at other rates, with linear interpolation
+            ind = pos + step*np.arange(x.shape[-1])
+            ind0 = ind.astype(int)
+            frac = (ind - ind0).astype(dtype)
+            output = shifted[..., ind0 % shifted.shape[-1]]*(1-frac) + shifted[..., (ind0+1) % shifted.shape[-1]]*frac
+            pos = (pos + step*x.shape[-1]) % shifted.shape[-1]
+            return output
         output = np.copy(shifted[..., int(pos) : int(pos) + x.shape[-1]])
         while output.shape[-1] < x.shape[-1]:
             output = np.hstack((output, shifted[..., :x.shape[-1]]))
@@ -318,18 +455,74 @@ def looper(notes=None, max_bend_semitones=bins_per_octave, slice_secs=None, elon
     return func
 
 
-def paulstretch(notes=None, max_bend_semitones=bins_per_octave, windowsize_secs=0.25, slice_secs=0.5, elongate_factor=0.05, max_scrub_secs=None, advance_factor=0, loop_mode=None, samplerate=44100, mono=True, **kwargs):
+def shift_spectra(freqs, pitch_shift, freq_grid=None, note=None, sources=None, rate=1, out_bins=None):
+    # moves bin i of each magnitude spectrum (last axis) to bin int(i * rap), summing bins that collide when shifting down
+    # with freq_grid, each spectrum is first transposed so that its source pitch lands on middle C, and then by note
+    # sources lists the source pitch of each window (in bins relative to middle C), where None falls back to the strongest bin
+    # rate is the ratio of the input to the output bin spacing, and out_bins the output spectrum size, for sources at another samplerate
+    rows = freqs.reshape(-1, freqs.shape[-1])
+    in_bins = rows.shape[-1]
+    out_bins = out_bins or in_bins
+    shifted = np.empty((len(rows), out_bins), dtype=rows.dtype)
+    channels = len(rows) // len(freqs)
+    for i, (row, out) in enumerate(zip(rows, shifted)):
+        denom = 1
+        row_shift = pitch_shift
+        if freq_grid is not None:
+            row_shift += note
+            source = sources[i // channels] if sources is not None else None
+            if source is None:
+                denom = freq_grid[np.argmax(row[1:]) + 1] / MIDDLE_C_FREQUENCY
+            else:
+                denom = 2**(source/bins_per_octave)
+        rap = 2**(row_shift/bins_per_octave) / denom * rate
+        if rap < 1:
+            out[:] = np.bincount((np.arange(in_bins) * rap).astype(int), weights=row, minlength=out_bins)[:out_bins]
+        else:
+            ind = (np.arange(out_bins) / rap).astype(int)
+            out[:] = row[np.minimum(ind, in_bins - 1)]
+            out[ind >= in_bins] = 0
+    return shifted.reshape(freqs.shape[:-1] + (out_bins,))
+
+
+def stretch_window(windowsize):
+    return ((1-np.linspace(-1, 1, windowsize)**2) ** 1.25).astype(dtype)
+
+
+def render_freeze_texture(shifted, window, frames, fade_frames, seed=None):
+    # synthesizes frames + fade_frames of a frozen spectrum like the live paulstretch windows, then crossfades the tail into the head
+    hop = len(window) // 2
+    num_windows = -(-(frames+fade_frames) // hop) + 1
+    spectra = np.empty((num_windows,) + shifted.shape[1:], dtype=complex_dtype)
+    get_table(shifted.shape[-1], complex_dtype, seed=seed).draw(np.random.default_rng(seed), spectra)
+    spectra *= shifted
+    bufs = np.fft.irfft(spectra).astype(dtype, copy=False)
+    bufs *= window
+    output = (bufs[1:, ..., :hop]+bufs[:-1, ..., hop:]) * stretch_gain
+    np.clip(output, -1, 1, out=output)
+    output = np.moveaxis(output, 0, -2).reshape(output.shape[1:-1] + (-1,))
+    texture = output[..., :frames].copy()
+    fade = np.sqrt(np.linspace(0, 1, fade_frames, dtype=dtype))  # equal power, as the overlapping parts are uncorrelated
+    texture[..., :fade_frames] = output[..., :fade_frames]*fade + output[..., frames : frames+fade_frames]*fade[::-1]
+    return texture
+
+
+def paulstretch(notes=None, max_bend_semitones=bins_per_octave, windowsize_secs=0.25, slice_secs=0.5, elongate_factor=0.05, max_scrub_secs=None, advance_factor=0, loop_mode=None, samplerate=44100, **kwargs):
     # adapted from https://github.com/paulnasca/paulstretch_python, https://github.com/paulnasca/paulstretch_cpp
-    # we currently use pysinewave which is (possibly duplicated) mono, so have to convert result to mono
+    # the output has the channel layout of the sample, which is decided when loading it
     track = kwargs['track']
     ctrl = kwargs['ctrl']
     sample = kwargs['sample']
+    sample_rate = kwargs.get('sample_rate') or samplerate  # the sample keeps its native rate, which the bin mapping converts to samplerate
+    pitch_index = kwargs.get('pitch_index')  # used for autotune with set, falling back to the strongest bin of each window
+    track_info = kwargs.get('track_info')  # gets the slice and the analysis position in the sample, for display
     smart_skipping = True
     if isinstance(sample, list):
         smart_skipping = all(s.shape[-1] == sample[0].shape[-1] for s in sample[1:])
         sample = sample[track]
+        sample_rate = sample_rate[track] if isinstance(sample_rate, list) else sample_rate
+        pitch_index = pitch_index and pitch_index[track]
         slice_secs = None
-    channels = len(sample.shape)
 
     elongate_steps = None
     slice_len = None
@@ -340,84 +533,148 @@ def paulstretch(notes=None, max_bend_semitones=bins_per_octave, windowsize_secs=
     pitch_knob = None
     shifted = None
     note = None
-    freqs = None
-    freqs0 = None
-
-    windowsize = get_windowsize(windowsize_secs, samplerate)
-    window = (1-np.linspace(-1, 1, windowsize)**2) ** 1.25
-    old_windowed_buf = np.zeros((channels if not mono else 1, windowsize)).squeeze()
+    freqs = None  # magnitude spectra of the last batch of windows, (windows, channels..., bins)
+    positions = None  # loop positions of these windows
+    loop_start = None
+    index_ready = False
+
+    windowsize = get_windowsize(windowsize_secs, sample_rate)  # analysis windows in sample frames
+    out_windowsize = get_windowsize(windowsize_secs, samplerate)  # synthesis windows in output frames
+    analysis_window = stretch_window(windowsize)
+    window = stretch_window(out_windowsize)
+    bin_rate = sample_rate / windowsize * out_windowsize / samplerate  # analysis bin spacing relative to the synthesis bin spacing
+    analysis_gain = out_windowsize / windowsize  # magnitudes grow with the analysis window length
+    old_windowed_buf = np.zeros(sample.shape[:-1] + (out_windowsize,), dtype=dtype)
     later = old_windowed_buf[..., :0]
+    rng = np.random.default_rng(None if random_seed is None else random_seed + track)
+    rand_freqs = None  # reused for every batch
+    phase_table = None
+    frozen = not advance_factor and freeze_texture_secs
+    texture_frames = round(freeze_texture_secs * samplerate)
+    fade_frames = min(round(freeze_crossfade_secs * samplerate), texture_frames)
+    texture_key = None
+    render_texture = None
+    texture = None  # the texture of the current frozen spectrum, once rendered
+    playing = None  # the texture that the last block was read from, or None for live synthesis
+    texture_pos = 0
+
+    def analyse(positions):
+        # magnitude spectra of the windows starting at positions, (windows, channels..., bins)
+        bufs = np.zeros((len(positions),) + loop_smp.shape[:-1] + (windowsize,), dtype=dtype)
+        for buf, start in zip(bufs, positions):
+            segment = loop_smp[..., start : start + windowsize]
+            buf[..., :segment.shape[-1]] = segment
+        bufs *= analysis_window
+
+        # get the amplitudes of the frequency components and discard the phases
+        with profiler.section('fft', track):
+            freqs = abs(np.fft.rfft(bufs)).astype(dtype, copy=False)  # numpy < 2 computes FFTs in double precision
+        if analysis_gain != 1:
+            freqs *= analysis_gain
+        return freqs
+
+    def shift(freqs):
+        freq_grid = None
+        sources = None
+        if ctrl.transport.get('set') and note is not None:
+            freq_grid = np.fft.rfftfreq(windowsize, d=1/sample_rate)
+            sources = [source_note(pitch_index, loop_to_sample(p, loop_start, slice_len), loop_to_sample(p + windowsize, loop_start, slice_len)) for p in positions]
+        if pitch_knob or freq_grid is not None or windowsize != out_windowsize or bin_rate != 1:
+            return shift_spectra(freqs, pitch_knob * max_bend_semitones, freq_grid=freq_grid, note=note, sources=sources,
+                                 rate=bin_rate, out_bins=out_windowsize//2 + 1)
+        return freqs
+
+    def synthesize(frames):
+        nonlocal pos, freqs, positions, shifted, old_windowed_buf, later, rand_freqs, phase_table
+        needed = frames - later.shape[-1]
+        if needed > 0:
+            # all the windows needed for this block are processed as one batch (freezing only needs a single analysis window)
+            hop = out_windowsize // 2
+            num_windows = -(-needed // hop) + stretch_lookahead_windows
+            batch_positions = []
+            for _ in range(num_windows):
+                batch_positions.append(int(pos))
+                pos += windowsize / 2 * advance_factor
+                if pos > loop_smp.shape[-1] - windowsize:
+                    pos = 0
 
-    def func(x):
-        nonlocal elongate_steps, slice_len, stable_last_slice_start, pos, scrub_knob, loop_smp, pitch_knob, shifted, note, windowsize, freqs, old_windowed_buf, later, freqs0
-        elongate_steps, slice_len, stable_last_slice_start, pos, scrub_knob, loop_smp, pitch_knob, shifted, note, windowsize, freqs = slice_scrub_bend(elongate_steps, ctrl, slice_len, sample, slice_secs, samplerate, elongate_factor, loop_mode, stable_last_slice_start, max_scrub_secs, pos, scrub_knob, track, loop_smp, pitch_knob, shifted, notes, note, freqs=freqs, windowsize=windowsize, advance_factor=advance_factor, smart_skipping=smart_skipping)
-        while later.shape[-1] < x.shape[-1]:
             if freqs is None or advance_factor:
-                # get the windowed buffer
-                buf = loop_smp[..., int(pos) : int(pos) + windowsize]
-                if buf.shape[-1] < windowsize:
-                    buf = np.hstack([buf, np.zeros((channels, windowsize - buf.shape[-1])).squeeze()])
-                buf = buf * window  # don't do *=
-
-                # get the amplitudes of the frequency components and discard the phases
-                freqs = abs(np.fft.rfft(buf))
-                if not pos:
-                    freqs0 = freqs
+                positions = batch_positions if advance_factor else batch_positions[:1]
+                freqs = analyse(positions)
                 shifted = None
-
             if shifted is None:
-                shifted = freqs
-                freq_grid = None
-                if ctrl.transport.get('set') and note is not None:
-                    freq_grid = np.fft.rfftfreq(freqs0.shape[-1], d=1/samplerate)
-                if pitch_knob or freq_grid is not None:
-                    if len(freqs.shape) == 1:
-                        freqs = freqs[None, ...]
-                    shifted = np.zeros_like(freqs)
-                    pitch_shift = pitch_knob * max_bend_semitones
-                    for ch in range(len(freqs)):
-                        denom = 1
-                        if freq_grid is not None:
-                            pitch_shift += note
-                            denom = freq_grid[(np.argmax(freqs[ch, 1:]) + 1)] / MIDDLE_C_FREQUENCY
-                        rap = 2**(pitch_shift/bins_per_octave) / denom
-                        if rap < 1:
-                            for i in range(freqs.shape[-1]):
-                                shifted[ch, int(i * rap)] += freqs[ch, i]
-                        else:
-                            for i in range(freqs.shape[-1]):
-                                shifted[ch, i] = freqs[ch, int(i / rap)]
-                    freqs = freqs.squeeze()
-                    shifted = shifted.squeeze()
-
-            # randomize the phases by multiplication with a random complex number with modulus=1
-            ph = rng.uniform(0, 2 * np.pi, (channels, freqs.shape[-1])).squeeze() * 1j
-            rand_freqs = shifted * np.exp(ph)
+                shifted = shift(freqs)
 
-            # do the inverse FFT
-            buf = np.fft.irfft(rand_freqs)
+            # randomize the phases by multiplication with a random complex number with modulus=1, drawn from a precomputed table
+            shape = (num_windows,) + shifted.shape[1:]
+            if rand_freqs is None or rand_freqs.shape[1:] != shape[1:] or len(rand_freqs) < num_windows:
+                rand_freqs = np.empty(shape, dtype=complex_dtype)
+                phase_table = get_table(shape[-1], complex_dtype, seed=random_seed)
+            spectra = phase_table.draw(rng, rand_freqs[:num_windows])
+            spectra *= shifted
 
-            if mono and channels > 1:
-                buf = librosa.to_mono(buf)
+            # do the inverse FFT
+            with profiler.section('fft', track):
+                bufs = np.fft.irfft(spectra).astype(dtype, copy=False)
 
-            # window again the output buffer
-            buf *= window
+            # window again the output buffers
+            bufs *= window
 
-            # overlap-add the output
-            output = (buf[..., : windowsize // 2]+old_windowed_buf[..., windowsize // 2 : windowsize]) / np.sqrt(2) * 1.6**2  # my estimated amplitude correction
-            old_windowed_buf = buf
+            # overlap-add the output: the first half of each window with the second half of the previous one
+            output = bufs[..., :hop] + np.concatenate((old_windowed_buf[None, ..., hop:], bufs[:-1, ..., hop:]))
+            output *= stretch_gain
+            old_windowed_buf = bufs[-1]
 
             # clamp the values to -1..1
-            output = np.clip(output, -1, 1)
+            np.clip(output, -1, 1, out=output)
 
-            later = np.hstack((later, output))
+            later = np.concatenate((later, np.moveaxis(output, 0, -2).reshape(output.shape[1:-1] + (-1,))), axis=-1)
 
-            pos += windowsize / 2 * advance_factor
-            if pos > loop_smp.shape[-1] - windowsize:
-                pos = 0
+        now = later[..., :frames]
+        later = later[..., frames:]
+        profiler.gauge('queue', later.shape[-1], track)
+        return now
 
-        now = later[..., :x.shape[-1]]
-        later = later[..., x.shape[-1]:]
+    def read(texture, frames):
+        if texture is None:
+            return synthesize(frames)
+        start = texture_pos % texture.shape[-1]
+        end = start + frames
+        if end <= texture.shape[-1]:
+            return texture[..., start:end].copy()
+        return np.take(texture, np.arange(start, end) % texture.shape[-1], axis=-1)  # per channel, unlike np.resize
+
+    def func(x):
+        nonlocal elongate_steps, slice_len, stable_last_slice_start, pos, scrub_knob, loop_smp, pitch_knob, shifted, note, windowsize, freqs, positions, loop_start, index_ready, later, texture_key, render_texture, texture, playing, texture_pos
+        elongate_steps, slice_len, stable_last_slice_start, pos, scrub_knob, loop_smp, pitch_knob, shifted, note, windowsize, freqs, loop_start = slice_scrub_bend(elongate_steps, ctrl, slice_len, sample, slice_secs, sample_rate, elongate_factor, loop_mode, stable_last_slice_start, max_scrub_secs, pos, scrub_knob, track, loop_smp, pitch_knob, shifted, notes, note, freqs=freqs, windowsize=windowsize, advance_factor=advance_factor, smart_skipping=smart_skipping, loop_start=loop_start)
+        if note is not None and pitch_index is not None and pitch_index.ready != index_ready:
+            index_ready = pitch_index.ready
+            shifted = None
+        if frozen:
+            # a frozen spectrum only gets new random phases, so a looped texture of it is rendered in the background and played once ready
+            if freqs is None:
+                positions = [int(pos)]
+                freqs = analyse(positions)
+                shifted = None
+            if shifted is None:
+                shifted = shift(freqs)
+                texture_key = (shifted.shape, hash(shifted.tobytes()))
+                render_texture = partial(render_freeze_texture, shifted, window, texture_frames, fade_frames, seed=random_seed)
+                texture = None
+            if texture is None:
+                texture = textures.get(texture_key, render_texture, owner=track)
+        if texture is playing:
+            now = read(texture, x.shape[-1])
+        else:
+            # crossfade when switching between live synthesis and textures
+            fade = np.linspace(0, 1, x.shape[-1], dtype=dtype)
+            now = read(playing, x.shape[-1])*(1-fade) + read(texture, x.shape[-1])*fade
+            if playing is None:
+                later = later[..., :0]  # live synthesis restarts from scratch when the texture is dropped
+            playing = texture
+        texture_pos += x.shape[-1]
+        if track_info is not None:
+            track_info.update(start=loop_start, length=slice_len, pos=loop_to_sample(int(pos), loop_start, slice_len))
         return now
     return func
 
@@ -0,0 +1,21 @@
+import numpy as np
+
+from controller import Controller
+from headless import VirtualMidiIn, VirtualMidiOut
+import pythotron
+from synths import looper
+from transport_clock import TransportClock
+
+
+def test_synced_loop_starts_from_its_start():
+    ctrl = Controller(pythotron.initial_knob_mode, midi_in=VirtualMidiIn(), midi_out=VirtualMidiOut())
+    clock = TransportClock(1, 44100)
+    clock.frames[0] = 12345  # the transport ran before the loop was built, e.g. when PLAY starts a take
+    sample = np.linspace(-1, 1, 1000, dtype=np.float32)
+    info = {}
+    waveform = clock.wrap(looper(ctrl=ctrl, sample=sample, track=0, clock=clock.voices[0], track_info=info, loop_mode=None), 0)
+    output = waveform(np.zeros(256))
+    assert info['pos'] == info['start']
+    assert output[0] == sample[info['start']]
+    output = waveform(np.zeros(256))
+    assert output[0] == sample[info['start'] + 256]
@@ -0,0 +1,11 @@
+from types import SimpleNamespace
+
+import pythotron
+from synths import get_note_and_chord
+
+
+def test_tracks_beyond_the_scale_keep_rising():
+    for register in range(2 * len(pythotron.notes)):
+        ctrl = SimpleNamespace(track_register=dict(syn=register))
+        pitches = [get_note_and_chord(ctrl, k, pythotron.notes) for k in range(3 * len(pythotron.notes[0]))]
+        assert all(a < b for a, b in zip(pitches, pitches[1:])), (register, pitches)
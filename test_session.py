@@ -0,0 +1,80 @@
+import os
+import socket
+
+import pytest
+
+import controller
+from event_log import EventRecorder, encode_state, read_log
+import latency
+import pythotron
+from replay import Replay
+from session import restore_session, save_session
+
+
+@pytest.fixture(autouse=True)
+def repo_dir(monkeypatch):
+    monkeypatch.chdir(os.path.dirname(os.path.abspath(__file__)))  # the sample folder is relative
+
+
+@pytest.fixture
+def free_osc_port(monkeypatch):
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    monkeypatch.setattr(controller, 'ip', '127.0.0.1')
+    monkeypatch.setattr(controller, 'port', port)
+
+
+def sampler_harness():
+    return latency.Harness([name for name, *_ in pythotron.synths].index('smp:stretch'))
+
+
+def test_restore_single_file_sample(tmp_path):
+    harness = sampler_harness()
+    harness.sound.update_sample(name_or_num='1_female-i-want-you.wav')
+    harness.settle(2)
+    harness.ctrl.track_register['smp'] = 1
+    harness.settle(2)
+    path = save_session(harness.ctrl, harness.sound, str(tmp_path / 'session'))
+
+    restored = sampler_harness()
+    restored.sound.update_sample(name_or_num='2_ahuva.wav')
+    assert restore_session(restored.ctrl, restored.sound, path) == path
+    assert restored.sound.sample_name == '1_female-i-want-you.wav'
+    assert restored.sound.sample_ind == harness.sound.sample_ind
+    assert restored.ctrl.track_register['smp'] == 1
+    assert restored.sound.sample.shape == harness.sound.sample.shape
+
+
+def test_restore_starts_and_stops_osc(tmp_path, free_osc_port):
+    harness = sampler_harness()
+    harness.ctrl.global_controls['osc'] = True
+    path = save_session(harness.ctrl, harness.sound, str(tmp_path / 'session'))
+
+    restored = sampler_harness()
+    try:
+        restore_session(restored.ctrl, restored.sound, path)
+        assert restored.ctrl.osc_server and restored.ctrl.global_controls['osc']
+        harness.ctrl.global_controls['osc'] = False
+        restore_session(restored.ctrl, restored.sound, save_session(harness.ctrl, harness.sound, str(tmp_path / 'session')))
+        assert not restored.ctrl.osc_server and not restored.ctrl.global_controls['osc']
+    finally:
+        restored.ctrl.stop_osc()
+
+
+def test_replay_restores_the_logged_session(tmp_path):
+    harness = sampler_harness()
+    harness.ctrl.track_register['smp'] = 2
+    path = save_session(harness.ctrl, harness.sound, str(tmp_path / 'session'))
+
+    capture = sampler_harness()
+    capture.ctrl.recorder = EventRecorder(capture.ctrl, capture.sound, str(tmp_path / 'events.jsonl'))
+    capture.settle(2)
+    restore_session(capture.ctrl, capture.sound, path)
+    capture.settle(2)
+    capture.ctrl.recorder.close()
+    assert [event['restore'] for event in read_log(capture.ctrl.recorder.path)[1] if 'restore' in event] == [path]
+
+    replay = Replay(capture.ctrl.recorder.path)
+    replay.run()
+    assert encode_state(replay.ctrl.get_state()) == encode_state(capture.ctrl.get_state())
@@ -0,0 +1,42 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+
+max_textures = 16  # least recently used textures beyond this are dropped
+background = True  # False renders on the calling thread, e.g. for deterministic replays
+
+
+class TextureCache:
+    # renders textures in a background thread and keeps the most recently used ones, so that callers never wait for a render
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='textures')
+        self.textures = OrderedDict()
+        self.pending = {}
+        self.owners = {}  # the last key each owner asked for, so that its superseded renders can be cancelled
+        self.lock = threading.Lock()
+
+    def get(self, key, render, owner=None):
+        # returns the texture for key if it is ready, otherwise schedules render() and returns None
+        with self.lock:
+            if key in self.textures:
+                self.textures.move_to_end(key)
+                return self.textures[key]
+            previous = self.owners.get(owner)
+            if previous != key and previous in self.pending and self.pending[previous].cancel():
+                del self.pending[previous]
+            self.owners[owner] = key
+            if key not in self.pending and background:
+                self.pending[key] = self.executor.submit(self.run, key, render)
+        if not background:
+            self.run(key, render)
+            return self.textures[key]
+        return None
+
+    def run(self, key, render):
+        texture = render()
+        with self.lock:
+            self.textures[key] = texture
+            self.pending.pop(key, None)
+            while len(self.textures) > max_textures:
+                self.textures.popitem(last=False)
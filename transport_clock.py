@@ -0,0 +1,45 @@
+import numpy as np
+
+
+tempo = 120  # beats per minute, for the beat positions
+
+
+class TransportClock:
+    # counts the frames rendered for each voice, so that the synths share a time base driven by the audio instead of the wall clock
+    # the voices stream in lockstep, so their counts agree up to the block in progress
+    def __init__(self, num_voices, samplerate, tempo=tempo):
+        self.samplerate = samplerate
+        self.tempo = tempo
+        self.frames = np.zeros(num_voices, dtype=np.int64)
+        self.voices = [VoiceClock(self, k) for k in range(num_voices)]
+
+    def wrap(self, waveform, k):
+        # counts every block of voice k, including the ones that inner wrappers skip rendering
+        frames = self.frames
+
+        def func(x):
+            output = waveform(x)
+            frames[k] += x.shape[-1]
+            return output
+        return func
+
+
+class VoiceClock:
+    # the clock as seen by the synth of one voice, given to the synth factories as the clock kwarg
+    # during a block, the positions are those of its start
+    def __init__(self, clock, k):
+        self.clock = clock
+        self.k = k
+        self.samplerate = clock.samplerate
+
+    @property
+    def frames(self):
+        return int(self.clock.frames[self.k])
+
+    @property
+    def secs(self):
+        return self.frames / self.samplerate
+
+    @property
+    def beat(self):
+        return self.secs * self.clock.tempo / 60
@@ -0,0 +1,64 @@
+from time import perf_counter
+
+import numpy as np
+
+from synths import dtype
+
+
+cpu_budget = 0.8  # fraction of real time that all voices together may spend rendering before the quietest ones are stolen
+load_smoothing = 0.9  # exponential smoothing of each voice's measured render load
+
+
+class VoiceAllocator:
+    # skips rendering voices that have faded out completely and steals the quietest voices when rendering exceeds the CPU budget
+    def __init__(self, num_voices, samplerate, min_db, release_secs, clock):
+        self.samplerate = samplerate
+        self.clock = clock  # a TransportClock, so that releases are timed in rendered audio
+        self.min_db = min_db
+        self.release_secs = release_secs  # how long a voice keeps rendering after its volume is set to min_db, i.e. until the fade out completes
+        self.volumes = np.full(num_voices, float(min_db))
+        self.silent_since = np.full(num_voices, -np.inf)  # NaN == not silent, as 0 is a valid time before the first block
+        self.loads = np.zeros(num_voices)
+        self.stolen = np.zeros(num_voices, dtype=bool)
+
+    def set_volume(self, k, volume):
+        # a new volume re-triggers a stolen voice
+        self.volumes[k] = volume
+        self.stolen[k] = False
+        self.silent_since[k] = self.clock.voices[k].secs if volume <= self.min_db else np.nan
+
+    def is_active(self, k):
+        return np.isnan(self.silent_since[k]) or self.clock.voices[k].secs - self.silent_since[k] < self.release_secs
+
+    def wrap(self, waveform, k):
+        resume = getattr(waveform, 'resume', None)  # e.g. render pool readers, which drop the blocks rendered ahead of the skipped ones
+        skipping = False
+
+        def func(x):
+            nonlocal skipping
+            if not self.is_active(k):
+                self.loads[k] = 0
+                skipping = True
+                return np.zeros(x.shape, dtype=dtype)
+            if skipping and resume:
+                resume(self.clock.frames[k])
+            skipping = False
+            start = perf_counter()
+            output = waveform(x)
+            self.loads[k] = load_smoothing*self.loads[k] + (1-load_smoothing) * (perf_counter()-start) * self.samplerate / x.shape[-1]
+            return output
+        return func
+
+    def steal(self):
+        # returns the voices to fade out so that the remaining load fits the budget
+        active = [k for k in range(len(self.volumes)) if self.is_active(k) and not self.stolen[k]]
+        total = sum(self.loads[k] for k in active)
+        stolen = []
+        while total > cpu_budget and len(active) > 1:
+            quietest = min(active, key=lambda k: self.volumes[k])
+            active.remove(quietest)
+            total -= self.loads[quietest]
+            self.stolen[quietest] = True
+            self.silent_since[quietest] = self.clock.voices[quietest].secs
+            stolen.append(quietest)
+        return stolen